@@ -1,50 +1,208 @@
 import os
-import io
 import re
+import json
+import hmac
+import base64
+import hashlib
 import random
 import math
-from flask import Flask, request, abort
-from dotenv import load_dotenv
-from PIL import Image
-from google import genai
-from google.genai import types
-
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
-    TextMessage,
-    ShowLoadingAnimationRequest,
-    QuickReply,
-    QuickReplyItem,
-    MessageAction
-)
-from linebot.v3.webhooks import MessageEvent, TextMessageContent, ImageMessageContent
+import time
+import atexit
+import contextlib
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import lazy
+from lazy import Lazy, lazy_import, timed
+
+BOOT_STARTED = time.perf_counter()
+with timed("flask"): from flask import Flask, request, abort, jsonify
+with timed("dotenv"): from dotenv import load_dotenv
+
+# linebot.v3 的 webhook / messaging model 與 google.genai 光 import 就要好幾秒，全部等第一次用到才載入 (見 lazy.py)
+Event, MessageEvent, TextMessageContent, ImageMessageContent, FileMessageContent = (lazy_import("linebot.v3.webhooks", name) for name in (
+    "Event", "MessageEvent", "TextMessageContent", "ImageMessageContent", "FileMessageContent"))
+UnknownEvent = lazy_import("linebot.v3.models.events", "UnknownEvent")
+Configuration, ReplyMessageRequest, PushMessageRequest, TextMessage, QuickReply, QuickReplyItem, MessageAction = (
+    lazy_import("linebot.v3.messaging", name) for name in (
+        "Configuration", "ReplyMessageRequest", "PushMessageRequest", "TextMessage", "QuickReply", "QuickReplyItem", "MessageAction"))
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
+
+with timed("prometheus_client"): from metrics import start_trace, finish_trace, stage, mark, render as render_metrics
+with timed("本地模組"):
+    from dispatcher import EventDispatcher, UserLocks
+    from deck_store import DeckStore, new_deck
+    from session_store import SessionStore, DuelRecord, StateRecord
+    from gemini_cache import ResponseCache
+    from image_hash import ImageHashIndex, dhash
+    from image_prep import prepare_image
+    from image_batch import ImageBatcher
+    from card_db import CardDB, card_name, format_card
+    from banlist import BanList, LIMIT_TW
+    from deck_import import try_add, import_deck, format_import_result, format_import_failure
+    from hand_sim import opening_odds, parse_groups, deck_key, format_odds, draw_hand, HAND_SIZES
+    from line_clients import LineClients
+    from gemini_rag import Retriever, JudgeModel, build_prompt
+    from gemini_gate import GeminiGate, GateTimeout
 
 load_dotenv()
+# 各模組 (Gemini token 用量、讀取動畫失敗等) 用 logging 記錄
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
 channel_secret = os.getenv('LINE_CHANNEL_SECRET')
 access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 
 app = Flask(__name__)
-configuration = Configuration(access_token=access_token)
-handler = WebhookHandler(channel_secret)
 
-client = genai.Client()
+# LAZY_STARTUP=1：啟動時不載入 linebot.v3 model / google.genai，也不建 LINE / Gemini client，第一次用到才載入 (scale-to-zero 冷啟動用)
+#   STARTUP_WARMUP=1 時開機 WARMUP_DELAY 秒後在背景把它們載完，之後的請求就不必再等
+# 預設 (0) 維持原本的行為：import 時全部載入，缺套件或設定錯誤一啟動就會發現
+LAZY_STARTUP = os.getenv('LAZY_STARTUP', '0') == '1'
+STARTUP_WARMUP = os.getenv('STARTUP_WARMUP', '1') == '1'
+WARMUP_DELAY = float(os.getenv('WARMUP_DELAY', '0.5'))
+
+# 整個 process 共用一組 LINE API 連線 (keep-alive)，不再每個事件重新連線
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', '10'))
+line = Lazy(lambda: LineClients(Configuration(access_token=access_token), pool_size=LINE_POOL_SIZE), "line", label="LineClients()")
+atexit.register(lazy.if_loaded(line, "close"))
+
+# Gemini client 同樣只建一次，底層 httpx 連線池在所有請求間共用
+client = Lazy(lambda: genai.Client(), "client", label="genai.Client()")
 MODEL_ID = 'gemini-2.5-flash'
 
+# CALLBACK_MODE=async：驗完簽章就回 OK，事件交給背景 worker 處理
+CALLBACK_MODE = os.getenv('CALLBACK_MODE', 'sync')
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', '4'))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '200'))
+# LINE 重送 webhook 時，REDELIVERY_TTL 秒內處理過的 webhookEventId 直接跳過 (每個 process 各自記)
+REDELIVERY_TTL = int(os.getenv('REDELIVERY_TTL', '600'))
+
+# 牌組/決鬥存檔位置 (SQLite)，多個 gunicorn worker 請指向同一個檔案
+# 修改先放在各 worker 的待寫區，DECK_FLUSH_INTERVAL 秒內寫入；同一筆被兩個 worker 改到時寫入會合併，不會互相蓋掉
+# 但寫入前別的 worker 看不到這筆修改：多 worker 又在意即時性可以設 0 (每次修改馬上寫)
+DECK_DB_PATH = os.getenv('DECK_DB_PATH', 'decks.db')
+DECK_FLUSH_INTERVAL = float(os.getenv('DECK_FLUSH_INTERVAL', '1.0'))
+
+# 對話狀態/決鬥多久沒動作就視為放棄 (秒)，以及記憶體上限 (user_states、user_duels 各自計算)
+# SESSION_MAX_ENTRIES 算的是筆數；SESSION_MAX_BYTES 才是記憶體 (依每筆紀錄估計的 bytes，0 = 不限)，超過任一個就丟最久沒用的
+STATE_TTL = int(os.getenv('STATE_TTL', '1800'))
+DUEL_TTL = int(os.getenv('DUEL_TTL', '21600'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Gemini 文字問答快取 (GEMINI_CACHE_PATH 留空就只放記憶體)
+GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', '2000'))
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', '21600'))
+GEMINI_CACHE_PATH = os.getenv('GEMINI_CACHE_PATH') or None
+# 存檔最多保留幾筆 (過期的會定期刪掉，超過上限從最舊的開始刪)
+GEMINI_CACHE_DISK_ROWS = int(os.getenv('GEMINI_CACHE_DISK_ROWS', '20000'))
+
+# 裁判設定建成 Gemini 快取內容重複使用 (GEMINI_PERSONA_CACHE=1 開啟)；RULINGS_PATH 是本地裁定檔
+# 預設關閉：目前的裁判設定只有幾百字，低於 Gemini 快取內容的最小 token 數，建了也只會失敗；設定加長 (例如放進常用裁定) 再開
+GEMINI_PERSONA_CACHE = os.getenv('GEMINI_PERSONA_CACHE', '0') == '1'
+GEMINI_PERSONA_TTL = int(os.getenv('GEMINI_PERSONA_TTL', '3600'))
+
+# Gemini 限流：每分鐘請求數 / token 數 (0 = 不限)、同時最多幾個請求、429/5xx 重試幾次
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', '0'))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', '0'))
+GEMINI_MAX_INFLIGHT = int(os.getenv('GEMINI_MAX_INFLIGHT', '8'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+# 收到訊息後 REPLY_DEADLINE 秒內還沒想完，就先用 reply token 回「稍後送達」，算完改用 push 補送 (push 會計入訊息額度)
+# 超過 GEMINI_DEADLINE 秒就不再等額度/重試
+REPLY_DEADLINE = float(os.getenv('REPLY_DEADLINE', '50'))
+GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '180'))
+GEMINI_WORKERS = int(os.getenv('GEMINI_WORKERS', '16'))
+
+# /metrics：處理超過 SLOW_EVENT_SECONDS 秒的事件，依 SLOW_EVENT_SAMPLE 的比例把各階段耗時寫進 log
+SLOW_EVENT_SECONDS = float(os.getenv('SLOW_EVENT_SECONDS', '3'))
+SLOW_EVENT_SAMPLE = float(os.getenv('SLOW_EVENT_SAMPLE', '1.0'))
+RULINGS_PATH = os.getenv('RULINGS_PATH', 'data/rulings.json')
+
+# 卡片照片辨識快取：雜湊相差不超過 IMAGE_HASH_DISTANCE 個 bit 就視為同一張卡
+IMAGE_HASH_DB_PATH = os.getenv('IMAGE_HASH_DB_PATH', 'image_hashes.db')
+IMAGE_HASH_DISTANCE = int(os.getenv('IMAGE_HASH_DISTANCE', '6'))
+# 辨識結果保存 IMAGE_HASH_TTL 秒 (預設 7 天)；禁卡表換版時會整批清掉
+IMAGE_HASH_TTL = int(os.getenv('IMAGE_HASH_TTL', str(7 * 86400)))
+
+# 上傳 Gemini 前先縮圖/重新壓縮 (IMAGE_FORMAT: JPEG 或 WEBP)
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1280'))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', '350000'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG')
+IMAGE_CROP_CARD = os.getenv('IMAGE_CROP_CARD', '0') == '1'
+
+# 多張照片合併成一次辨識：同一位使用者 IMAGE_BATCH_WINDOW 秒內的圖片 / 同一組圖片最多等 IMAGE_SET_TIMEOUT 秒
+IMAGE_BATCH_WINDOW = float(os.getenv('IMAGE_BATCH_WINDOW', '1.0'))
+IMAGE_SET_TIMEOUT = float(os.getenv('IMAGE_SET_TIMEOUT', '5.0'))
+IMAGE_BATCH_MAX = int(os.getenv('IMAGE_BATCH_MAX', '10'))
+# 每張照片一到就開始下載 + 縮圖，最多同時 IMAGE_PREFETCH_WORKERS 張
+IMAGE_PREFETCH_WORKERS = int(os.getenv('IMAGE_PREFETCH_WORKERS', '8'))
+
+# 本地卡片資料庫：CARD_DB_DUMP 是隨附的卡片資料 JSON，資料庫是空的時候會自動匯入
+CARD_DB_PATH = os.getenv('CARD_DB_PATH', 'cards.db')
+CARD_DB_DUMP = os.getenv('CARD_DB_DUMP', 'data/cards.json')
+
+# 本地禁卡表：把新版本的 JSON 丟進 BANLIST_DIR 即可，每 BANLIST_REFRESH 秒檢查一次
+BANLIST_DIR = os.getenv('BANLIST_DIR', 'banlists')
+BANLIST_REFRESH = int(os.getenv('BANLIST_REFRESH', '60'))
+
+# 起手機率的模擬次數
+SIM_TRIALS = int(os.getenv('SIM_TRIALS', '100000'))
+
 # ==========================================
-# 暫存資料庫
-# user_decks 結構: {"user_id": {"白龍": {"main": {}, "extra": {}, "side": {}}}}
-# user_duels 結構: {"user_id": {"我方": 8000, "對方": 8000, "target": None}}
-# user_states 結構: {"user_id": {"state": "NONE", "data": {}}} -> 用來記錄對話步驟！
+# 資料庫
+# deck_store 牌組: deck_store.decks(user_id) -> {"白龍": {"main": {}, "extra": {}, "side": {}}} (存進 SQLite)
+# user_duels 結構: {"user_id": DuelRecord(我方=8000, 對方=8000, target=None)} (每次處理完同步到 deck_store)
+# user_states 結構: {"user_id": StateRecord(state, data)} -> 用來記錄對話步驟！(NONE 狀態不佔空間)
+# 兩者都有 TTL、筆數上限與估計記憶體上限；過期的決鬥連存檔一起刪掉，被 LRU 擠掉的下次再從存檔讀回來
 # ==========================================
-user_decks = {}  
-user_duels = {}  
-user_states = {} 
+deck_store = DeckStore(DECK_DB_PATH, flush_interval=DECK_FLUSH_INTERVAL)
+user_duels = SessionStore(DUEL_TTL, SESSION_MAX_ENTRIES, on_expire=lambda uid, duel: deck_store.save_duel(uid, None),
+                          max_bytes=SESSION_MAX_BYTES or None)
+user_states = SessionStore(STATE_TTL, SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES or None)
+answer_cache = ResponseCache(GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL, GEMINI_CACHE_PATH, GEMINI_CACHE_DISK_ROWS)
+image_index = ImageHashIndex(IMAGE_HASH_DB_PATH, IMAGE_HASH_DISTANCE, IMAGE_HASH_TTL)
+card_db = CardDB(CARD_DB_PATH)
+if not card_db and os.path.exists(CARD_DB_DUMP): card_db.load_dump(CARD_DB_DUMP)
+
+banlist = BanList(BANLIST_DIR, BANLIST_REFRESH, card_db)
+BANLIST_QUERY = re.compile(r'^(?:查詢)?(?:當下)?(?:最新)?禁卡表$')
+BANLIST_DIFF = re.compile(r'^禁卡表比較(?:\s+(\S+))?(?:\s+(\S+))?$')
+
+# Gemini 問答：先查本地資料放進提示，本地查不到才開 google_search
+retriever = Retriever(card_db, banlist, RULINGS_PATH)
+gate = GeminiGate(GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_INFLIGHT, GEMINI_MAX_RETRIES, default_timeout=GEMINI_DEADLINE)
+judge = JudgeModel(client, MODEL_ID, use_cache=GEMINI_PERSONA_CACHE, cache_ttl=GEMINI_PERSONA_TTL, gate=gate)
+gemini_pool = ThreadPoolExecutor(max_workers=GEMINI_WORKERS, thread_name_prefix="gemini")
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_PREFETCH_WORKERS, thread_name_prefix="image")
+
+# 「查卡 灰流麗」「灰流麗效果」「灰流麗是什麼卡」這類單純查卡文的問題
+CARD_QUERY = re.compile(r'^(?:查卡\s*(?P<a>.+)|(?P<b>.+?)\s*(?:的)?(?:卡片效果|效果|是什麼卡|是什麼)[?？]*)$')
+
+# /metrics 的 command 標籤：把訊息歸類成固定幾種，避免標籤數量爆炸
+GLOBAL_COMMANDS = ["決鬥計算機", "開啟計算機", "我的牌組", "功能選單", "隨機工具", "取消"]
+COMMAND_PATTERNS = [
+    ("cancel", re.compile(r'^取消$')),
+    ("duel_menu", re.compile(r'^(開啟計算機|決鬥計算機|選擇調整我方|選擇調整對方|決鬥結算選單|決鬥開始|重新決鬥)$')),
+    ("duel_math", re.compile(r'^([+-]\s*\d+|生命值減半)$')),
+    ("duel_end", re.compile(r'^(我方|對方)(投降|特殊勝利)$')),
+    ("dice", re.compile(r'^擲骰子')),
+    ("coin", re.compile(r'^擲硬幣')),
+    ("menu", re.compile(r'^(隨機工具|功能選單)$')),
+    ("deck_menu", re.compile(r'^(我的牌組|流程_\S+)$')),
+    ("deck_edit", re.compile(r'^準備(新增主牌|新增額外|新增備牌|刪除卡片) ')),
+    ("deck_import", re.compile(r'^準備匯入牌組 ')),
+    ("deck_view", re.compile(r'^(繼續編輯|查看特定牌組) ')),
+    ("hand_sim", re.compile(r'^(抽起手|起手機率) ')),
+    ("banlist", re.compile(r'^((?:查詢)?(?:當下)?(?:最新)?禁卡表$|禁卡表比較)')),
+    ("card_lookup", CARD_QUERY),
+]
+
+def command_of(text, state):
+    if state != "NONE" and text not in GLOBAL_COMMANDS: return "state_input"
+    return next((name for name, pattern in COMMAND_PATTERNS if pattern.match(text)), "ask")
 
 # --- 輔助函式：計算機快捷鍵 ---
 def get_duel_menu():
@@ -57,394 +215,722 @@ def get_duel_menu():
     ])
 
 def reset_state(user_id):
-    user_states[user_id] = {"state": "NONE", "data": {}}
+    user_states.pop(user_id)
+
+# ==========================================
+# Webhook：驗簽只用標準函式庫 (與 SDK 的 SignatureValidator 相同算法)，事件真正要處理時才轉成 SDK 的 model
+# 這樣不必為了回 OK 先載入 WebhookHandler 連帶的整套 webhook model；async 模式的 OK 完全不用等 SDK
+# handler 對照表也自己記 (key 規則與 WebhookHandler 相同：MessageEvent_TextMessageContent)
+# ==========================================
+event_handlers = {}
+
+def on_event(event, message=None):
+    key = event.__name__ if message is None else f"{event.__name__}_{message.__name__}"
+    def decorator(func):
+        event_handlers[key] = func
+        return func
+    return decorator
+
+def verify_signature(body, signature):
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(digest))
+
+def parse_event(data):
+    try: return Event.from_dict(data)
+    except ValueError:
+        logger.info("未知的事件類型：%s", data.get("type"))
+        return UnknownEvent.new_from_json_dict(data)
+
+# --- 依事件類型找出對應的 handler (與 WebhookHandler.handle 相同的對應規則) ---
+def dispatch_event(event):
+    func = None
+    if isinstance(event, MessageEvent):
+        func = event_handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None: func = event_handlers.get(event.__class__.__name__)
+    if func is None: return
+    try: func(event)
+    finally: finish_trace(SLOW_EVENT_SECONDS, SLOW_EVENT_SAMPLE)
+
+# webhook 裡的原始 JSON 事件 -> SDK model -> handler
+def handle_event(data):
+    with stage("parse", "webhook"): event = parse_event(data)
+    dispatch_event(event)
+
+def event_user_id(data):
+    return data.get("source", {}).get("userId")
+
+# 同一位使用者的事件必須依序執行，否則連點兩次 -1000 之類的操作會互相覆蓋
+# 等 Gemini 的 worker 不算在 WORKER_COUNT 內，最多再補到 GEMINI_WORKERS 個
+dispatcher = None
+user_locks = UserLocks()
+if CALLBACK_MODE == 'async':
+    dispatcher = EventDispatcher(handle_event, workers=WORKER_COUNT, maxsize=EVENT_QUEUE_SIZE, key_fn=event_user_id,
+                                 max_threads=WORKER_COUNT + GEMINI_WORKERS).start()
+    atexit.register(dispatcher.shutdown)
+
+# --- 重送去重：回 503 或逾時時 LINE 會把整包 webhook 重送，已經收下的事件不能再跑一次 (例如 -1000 扣兩次) ---
+delivered = SessionStore(REDELIVERY_TTL, 100000)
+delivered_lock = threading.Lock()
+
+def first_delivery(data):
+    event_id = data.get("webhookEventId")
+    if not event_id: return True
+    with delivered_lock:
+        if delivered.get(event_id): return False
+        delivered[event_id] = True
+    return True
+
+def forget_delivery(data):
+    if data.get("webhookEventId"): delivered.pop(data["webhookEventId"])
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    try: handler.handle(body, signature)
-    except InvalidSignatureError: abort(400)
+    with stage("verify", "webhook"): valid = verify_signature(body, signature)
+    if not valid: abort(400)
+    events = [data for data in json.loads(body)["events"] if first_delivery(data)]
+
+    if dispatcher is None:
+        for data in events:
+            with user_locks.get(event_user_id(data)): handle_event(data)
+        return 'OK'
+
+    # 佇列塞滿時回 503，讓 LINE 稍後重送；整包 webhook 最多等 submit_timeout 秒
+    # 塞不進去的那個和之後的事件都不收 (重送時才會照原本順序)，已收下的靠 first_delivery 跳過
+    deadline = time.monotonic() + dispatcher.submit_timeout
+    for i, data in enumerate(events):
+        if not dispatcher.submit(data, max(0.0, deadline - time.monotonic())):
+            for rest in events[i:]: forget_delivery(rest)
+            abort(503)
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessageContent)
+@app.route("/stats", methods=['GET'])
+def stats():
+    return jsonify({"dispatcher": dispatcher.stats() if dispatcher else None, "deck_store": deck_store.stats,
+                    "user_states": user_states.snapshot_stats(), "user_duels": user_duels.snapshot_stats(),
+                    "answer_cache": answer_cache.snapshot_stats(),
+                    "image_index": image_index.snapshot_stats(),
+                    "image_batcher": image_batcher.stats,
+                    "card_db": {"size": card_db.size},
+                    "line": line.snapshot_stats() if lazy.is_loaded(line) else None,
+                    "gemini": judge.snapshot_stats(), "retrieval": retriever.stats,
+                    "gemini_gate": gate.snapshot_stats(), "startup": lazy.snapshot_stats()})
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    payload, content_type = render_metrics()
+    return payload, 200, {"Content-Type": content_type}
+
+@on_event(MessageEvent, message=TextMessageContent)
 def handle_text(event):
     user_id = event.source.user_id
     user_message = event.message.text.strip()
-    
-    # 初始化使用者資料庫
-    if user_id not in user_decks: user_decks[user_id] = {}
-    if user_id not in user_states: reset_state(user_id)
+    session = user_states.get(user_id)  # 過期或沒有 -> 等同 reset_state() 後的 NONE
+    current_state = session.state if session else "NONE"
+    start_trace(command_of(user_message, current_state), current_state)
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try: line_bot_api.show_loading_animation(ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=5))
-        except: pass
-
-        reply_messages = []
-        current_state = user_states[user_id]["state"]
-
-        # ==========================================
-        # 全域中斷指令 (如果使用者中途點擊其他選單，重置狀態)
-        # ==========================================
-        if user_message in ["決鬥計算機", "開啟計算機", "我的牌組", "功能選單", "隨機工具", "取消"]:
-            reset_state(user_id)
-            current_state = "NONE"
-
-        # ==========================================
-        # 狀態機 (State Machine) - 處理多步驟對話
-        # ==========================================
-        if current_state != "NONE":
-            state_data = user_states[user_id]["data"]
-
-            # 1. 建立牌組 - 等待輸入名稱
-            if current_state == "WAIT_CREATE_DECK":
-                deck_name = user_message
-                if deck_name in user_decks[user_id]:
-                    reply_messages.append(TextMessage(text=f"❌ 牌組【{deck_name}】已經存在囉！請換個名字，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-                else:
-                    user_decks[user_id][deck_name] = {"main": {}, "extra": {}, "side": {}}
-                    reset_state(user_id)
-                    reply_messages.append(TextMessage(text=f"✅ 成功建立牌組：【{deck_name}】！\n請點擊「我的牌組」進入編輯。"))
-
-            # 2. 編輯牌組 - 等待輸入要編輯的目標牌組
-            elif current_state == "WAIT_EDIT_TARGET":
-                deck_name = user_message
-                if deck_name not in user_decks[user_id]:
-                    reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】！請確認名稱是否正確，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-                else:
-                    reset_state(user_id)
-                    reply_messages.append(TextMessage(
-                        text=f"🎯 已鎖定牌組【{deck_name}】！\n請選擇你要進行的操作：",
-                        quick_reply=QuickReply(items=[
-                            QuickReplyItem(action=MessageAction(label="➕ 新增主牌", text=f"準備新增主牌 {deck_name}")),
-                            QuickReplyItem(action=MessageAction(label="➕ 新增額外", text=f"準備新增額外 {deck_name}")),
-                            QuickReplyItem(action=MessageAction(label="➕ 新增備牌", text=f"準備新增備牌 {deck_name}")),
-                            QuickReplyItem(action=MessageAction(label="🗑️ 刪除卡片", text=f"準備刪除卡片 {deck_name}")),
-                            QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
-                        ])
-                    ))
-
-            # 3. 刪除牌組 - 等待輸入要刪除的目標
-            elif current_state == "WAIT_DELETE_TARGET":
-                deck_name = user_message
-                if deck_name not in user_decks[user_id]:
-                    reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】！請確認名稱，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-                else:
-                    user_states[user_id] = {"state": "WAIT_DELETE_CONFIRM", "data": {"deck_name": deck_name}}
-                    reply_messages.append(TextMessage(
-                        text=f"⚠️ 警告：確定要永久刪除牌組【{deck_name}】嗎？\n此動作無法復原！",
-                        quick_reply=QuickReply(items=[
-                            QuickReplyItem(action=MessageAction(label="✅ 確定刪除", text="確認刪除牌組")),
-                            QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))
-                        ])
-                    ))
-
-            # 4. 刪除牌組 - 二次確認
-            elif current_state == "WAIT_DELETE_CONFIRM":
-                if user_message == "確認刪除牌組":
-                    deck_name = state_data["deck_name"]
-                    del user_decks[user_id][deck_name]
-                    reset_state(user_id)
-                    reply_messages.append(TextMessage(text=f"🗑️ 已成功刪除牌組【{deck_name}】！"))
-                else:
-                    reset_state(user_id)
-                    reply_messages.append(TextMessage(text="已取消刪除操作。"))
-
-            # 5. 新增/刪除單卡 - 處理輸入的卡名與數量
-            elif current_state in ["WAIT_ADD_CARD", "WAIT_REMOVE_CARD"]:
-                deck_name = state_data["deck_name"]
-                action_type = state_data["type"] # main, extra, side, or remove
-                
-                deck_data = user_decks[user_id][deck_name]
-                items = {}
-                
-                # 解析輸入字串 (例: 灰流麗*3 融合)
-                for item in user_message.split():
-                    if '*' in item:
-                        parts = item.rsplit('*', 1)
-                        try: items[parts[0]] = int(parts[1])
-                        except: items[item] = 1
-                    else: items[item] = 1
-
-                log, error_log = [], []
-                
-                if current_state == "WAIT_ADD_CARD":
-                    dt_tw = "主牌組" if action_type == "main" else ("額外牌組" if action_type == "extra" else "備牌")
-                    limits = {"main": 60, "extra": 15, "side": 15}
-                    
-                    for c_name, c_cnt in items.items():
-                        current_type_total = sum(deck_data[action_type].values())
-                        current_card_total = sum(deck_data[d].get(c_name, 0) for d in ["main", "extra", "side"])
-
-                        if current_type_total + c_cnt > limits[action_type]:
-                            error_log.append(f"❌ {c_name}：{dt_tw}已達上限 ({limits[action_type]}張)")
-                            continue
-                        if current_card_total + c_cnt > 3:
-                            error_log.append(f"❌ {c_name}：同名卡最多3張 (現有{current_card_total}張)")
-                            continue
-
-                        deck_data[action_type][c_name] = deck_data[action_type].get(c_name, 0) + c_cnt
-                        log.append(f"✅ {c_name} * {c_cnt}")
-                        
-                else: # WAIT_REMOVE_CARD
-                    for c_name, c_cnt in items.items():
-                        remaining = c_cnt
-                        for dt in ["main", "extra", "side"]:
-                            if remaining <= 0: break
-                            if c_name in deck_data[dt]:
-                                del_amt = min(deck_data[dt][c_name], remaining)
-                                deck_data[dt][c_name] -= del_amt
-                                remaining -= del_amt
-                                if deck_data[dt][c_name] == 0: del deck_data[dt][c_name]
-                        actual_del = c_cnt - remaining
-                        if actual_del > 0: log.append(f"🗑️ 移除 {c_name} * {actual_del}")
-                        else: log.append(f"⚠️ 牌組中找不到 {c_name}")
+    # 初始化使用者資料庫
+    decks = deck_store.decks(user_id)
+    # 這次事件唯一一次計入命中率、延長期限的讀取，後面的 `in` / user_duels[user_id] 都只是 peek
+    # 記憶體裡沒有、或別的 worker 改過這場決鬥 (updated_at 不同) 才從存檔重讀，不然會拿舊的 LP 蓋掉對方的修改
+    duel = user_duels.get(user_id)
+    if duel is None or deck_store.duel_changed(user_id):
+        saved_duel = deck_store.duel(user_id, max_age=DUEL_TTL)
+        if saved_duel: user_duels[user_id] = duel = DuelRecord.from_dict(saved_duel)
+        elif duel is not None:
+            user_duels.pop(user_id)
+            duel = None
+    duel_before = duel.to_dict() if duel else None
+
+    # 讀取動畫只在慢的路徑 (起手模擬、Gemini、圖片) 才送：快的指令早就回覆了，動畫反而在回覆之後才出現
+    reply_messages = []
+    mark("load")
+
+    # ==========================================
+    # 全域中斷指令 (如果使用者中途點擊其他選單，重置狀態)
+    # ==========================================
+    if user_message in GLOBAL_COMMANDS:
+        reset_state(user_id)
+        current_state = "NONE"
+
+    # ==========================================
+    # 狀態機 (State Machine) - 處理多步驟對話
+    # ==========================================
+    if current_state != "NONE":
+        state_data = session.data
+
+        # 1. 建立牌組 - 等待輸入名稱
+        if current_state == "WAIT_CREATE_DECK":
+            deck_name = user_message
+            if deck_name in decks:
+                reply_messages.append(TextMessage(text=f"❌ 牌組【{deck_name}】已經存在囉！請換個名字，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
+            else:
+                deck_store.save_deck(user_id, deck_name, new_deck())
+                reset_state(user_id)
+                reply_messages.append(TextMessage(text=f"✅ 成功建立牌組：【{deck_name}】！\n請點擊「我的牌組」進入編輯。"))
 
+        # 2. 編輯牌組 - 等待輸入要編輯的目標牌組
+        elif current_state == "WAIT_EDIT_TARGET":
+            deck_name = user_message
+            if deck_name not in decks:
+                reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】！請確認名稱是否正確，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
+            else:
                 reset_state(user_id)
-                res_text = f"🗂️ 【{deck_name}】更新結果：\n"
-                if log: res_text += "\n".join(log) + "\n"
-                if error_log: res_text += "\n".join(error_log)
-                
-                # 附上返回該牌組選單的按鈕
                 reply_messages.append(TextMessage(
-                    text=res_text.strip(),
+                    text=f"🎯 已鎖定牌組【{deck_name}】！\n請選擇你要進行的操作：",
                     quick_reply=QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(label="🔙 繼續編輯此牌組", text=f"繼續編輯 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="➕ 新增主牌", text=f"準備新增主牌 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="➕ 新增額外", text=f"準備新增額外 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="➕ 新增備牌", text=f"準備新增備牌 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="🗑️ 刪除卡片", text=f"準備刪除卡片 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="📥 匯入整副", text=f"準備匯入牌組 {deck_name}")),
                         QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
                     ])
                 ))
 
-        # ==========================================
-        # 一般指令路由 (沒有在對話狀態中時)
-        # ==========================================
-        if current_state == "NONE" and not reply_messages:
-            
-            # --- 取消指令 ---
-            if user_message == "取消":
-                reply_messages.append(TextMessage(text="✅ 已取消目前操作。"))
-
-            # --- 計算機系統 (修復關鍵點！) ---
-            elif user_message in ["開啟計算機", "決鬥計算機"]:
-                if user_id not in user_duels:
-                    user_duels[user_id] = {"我方": 8000, "對方": 8000, "target": None}
-                    text = "⚔️ 決鬥開始！ ⚔️\n➖➖➖➖➖➖\n我方 LP: 8000\n對方 LP: 8000\n\n👇 請選擇要調整哪一方的血量："
-                else:
-                    p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
-                    text = f"⚔️ 計算機運作中\n➖➖➖➖➖➖\n我方 LP: {p1}\n對方 LP: {p2}\n\n👇 請選擇要調整哪一方的血量："
-                reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu()))
-
-            elif user_message in ["選擇調整我方", "選擇調整對方"]:
-                if user_id not in user_duels: user_duels[user_id] = {"我方": 8000, "對方": 8000, "target": None}
-                target = "我方" if "我方" in user_message else "對方"
-                user_duels[user_id]["target"] = target
-                
+        # 3. 刪除牌組 - 等待輸入要刪除的目標
+        elif current_state == "WAIT_DELETE_TARGET":
+            deck_name = user_message
+            if deck_name not in decks:
+                reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】！請確認名稱，或點擊「取消」。", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
+            else:
+                user_states[user_id] = StateRecord("WAIT_DELETE_CONFIRM", {"deck_name": deck_name})
                 reply_messages.append(TextMessage(
-                    text=f"🎯 已鎖定【{target}】\n請輸入數字 (例: -1000)\n或點擊常用數值：",
+                    text=f"⚠️ 警告：確定要永久刪除牌組【{deck_name}】嗎？\n此動作無法復原！",
                     quick_reply=QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(label="-1000", text="-1000")),
-                        QuickReplyItem(action=MessageAction(label="-500", text="-500")),
-                        QuickReplyItem(action=MessageAction(label="+1000", text="+1000")),
-                        QuickReplyItem(action=MessageAction(label="÷2 (減半)", text="生命值減半")),
-                        QuickReplyItem(action=MessageAction(label="↩️ 取消", text="開啟計算機"))
+                        QuickReplyItem(action=MessageAction(label="✅ 確定刪除", text="確認刪除牌組")),
+                        QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))
                     ])
                 ))
 
-            elif user_message == "生命值減半":
-                if user_id in user_duels and user_duels[user_id].get("target"):
-                    target = user_duels[user_id]["target"]
-                    user_duels[user_id][target] = math.ceil(user_duels[user_id][target] / 2)
-                    p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
-                    reply_messages.append(TextMessage(text=f"🩸 【血量更新】\n我方 LP: {p1}\n對方 LP: {p2}", quick_reply=get_duel_menu()))
-                else:
-                    reply_messages.append(TextMessage(text="❌ 請先點擊「👈 調整我方」或「👉 調整對方」！", quick_reply=get_duel_menu()))
-
-            elif match := re.match(r'^([+-])\s*(\d+)$', user_message):
-                if user_id in user_duels and user_duels[user_id].get("target"):
-                    target = user_duels[user_id]["target"]
-                    operator, amount = match.group(1), int(match.group(2))
-                    if operator == '+': user_duels[user_id][target] += amount
-                    else: user_duels[user_id][target] -= amount
-                    
-                    p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
-                    text = f"🩸 【血量更新】 ({target} {operator}{amount})\n我方 LP: {p1}\n對方 LP: {p2}"
-                    
-                    if p1 <= 0 or p2 <= 0:
-                        text += "\n➖➖➖➖➖➖\n🏆 決鬥結束 🏆\n"
-                        if p1 <= 0 and p2 <= 0: text += "雙方血量歸零，平局 (DRAW)！"
-                        elif p1 <= 0: text += "我方血量歸零，對方獲勝！"
-                        else: text += "對方血量歸零，我方獲勝！"
-                        del user_duels[user_id]
-                        reply_messages.append(TextMessage(text=text))
-                    else:
-                        reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu()))
-                else:
-                    reply_messages.append(TextMessage(text="❌ 請先選擇目標！", quick_reply=get_duel_menu()))
+        # 4. 刪除牌組 - 二次確認
+        elif current_state == "WAIT_DELETE_CONFIRM":
+            if user_message == "確認刪除牌組":
+                deck_name = state_data["deck_name"]
+                deck_store.delete_deck(user_id, deck_name)
+                reset_state(user_id)
+                reply_messages.append(TextMessage(text=f"🗑️ 已成功刪除牌組【{deck_name}】！"))
+            else:
+                reset_state(user_id)
+                reply_messages.append(TextMessage(text="已取消刪除操作。"))
 
-            elif user_message == "決鬥結算選單":
-                reply_messages.append(TextMessage(
-                    text="⚙️ 請選擇結算方式或重新開始：",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(label="🏳️ 我方投降", text="我方投降")),
-                        QuickReplyItem(action=MessageAction(label="🏳️ 對方投降", text="對方投降")),
-                        QuickReplyItem(action=MessageAction(label="✨ 我方特殊勝利", text="我方特殊勝利")),
-                        QuickReplyItem(action=MessageAction(label="🔄 重新決鬥 (重置)", text="決鬥開始"))
-                    ])
-                ))
+        # 5. 新增/刪除單卡 - 處理輸入的卡名與數量
+        elif current_state in ["WAIT_ADD_CARD", "WAIT_REMOVE_CARD"]:
+            deck_name = state_data["deck_name"]
+            action_type = state_data["type"] # main, extra, side, or remove
+            
+            deck_data = decks[deck_name]
+            items = {}
+            
+            # 解析輸入字串 (例: 灰流麗*3 融合)
+            for item in user_message.split():
+                if '*' in item:
+                    parts = item.rsplit('*', 1)
+                    try: items[parts[0]] = int(parts[1])
+                    except ValueError: items[item] = 1
+                else: items[item] = 1
+
+            log, error_log = [], []
+            
+            if current_state == "WAIT_ADD_CARD":
+                ban_version = banlist.current_version
+                for c_name, c_cnt in items.items():
+                    c_name, note, error = try_add(deck_data, action_type, c_name, c_cnt, card_db, banlist, ban_version)
+                    if note: log.append(note)
+                    if error: error_log.append(error)
+                    else: log.append(f"✅ {c_name} * {c_cnt}")
+
+            else: # WAIT_REMOVE_CARD
+                for c_name, c_cnt in items.items():
+                    if card_db and c_name not in deck_data.card_total:
+                        card, _ = card_db.resolve(c_name)
+                        if card: c_name = card_name(card)
+                    actual_del = deck_data.remove(c_name, c_cnt)
+                    if actual_del > 0: log.append(f"🗑️ 移除 {c_name} * {actual_del}")
+                    else: log.append(f"⚠️ 牌組中找不到 {c_name}")
+
+            deck_store.save_deck(user_id, deck_name, deck_data)
+            reset_state(user_id)
+            res_text = f"🗂️ 【{deck_name}】更新結果：\n"
+            if log: res_text += "\n".join(log) + "\n"
+            if error_log: res_text += "\n".join(error_log)
+            
+            # 附上返回該牌組選單的按鈕
+            reply_messages.append(TextMessage(
+                text=res_text.strip(),
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(label="🔙 繼續編輯此牌組", text=f"繼續編輯 {deck_name}")),
+                    QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
+                ])
+            ))
+
+        # 6. 匯入整副牌組 - 等待貼上卡表 (.ydk 檔案由 handle_file 處理)
+        elif current_state == "WAIT_IMPORT_DECK":
+            reply_messages.append(import_into_deck(user_id, state_data["deck_name"], user_message.splitlines()))
+
+    mark("state")
+
+    # ==========================================
+    # 一般指令路由 (沒有在對話狀態中時)
+    # ==========================================
+    if current_state == "NONE" and not reply_messages:
+        
+        # --- 取消指令 ---
+        if user_message == "取消":
+            reply_messages.append(TextMessage(text="✅ 已取消目前操作。"))
+
+        # --- 計算機系統 (修復關鍵點！) ---
+        elif user_message in ["開啟計算機", "決鬥計算機"]:
+            if user_id not in user_duels:
+                user_duels[user_id] = DuelRecord()
+                text = "⚔️ 決鬥開始！ ⚔️\n➖➖➖➖➖➖\n我方 LP: 8000\n對方 LP: 8000\n\n👇 請選擇要調整哪一方的血量："
+            else:
+                p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
+                text = f"⚔️ 計算機運作中\n➖➖➖➖➖➖\n我方 LP: {p1}\n對方 LP: {p2}\n\n👇 請選擇要調整哪一方的血量："
+            reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu()))
+
+        elif user_message in ["選擇調整我方", "選擇調整對方"]:
+            if user_id not in user_duels: user_duels[user_id] = DuelRecord()
+            target = "我方" if "我方" in user_message else "對方"
+            user_duels[user_id]["target"] = target
+            
+            reply_messages.append(TextMessage(
+                text=f"🎯 已鎖定【{target}】\n請輸入數字 (例: -1000)\n或點擊常用數值：",
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(label="-1000", text="-1000")),
+                    QuickReplyItem(action=MessageAction(label="-500", text="-500")),
+                    QuickReplyItem(action=MessageAction(label="+1000", text="+1000")),
+                    QuickReplyItem(action=MessageAction(label="÷2 (減半)", text="生命值減半")),
+                    QuickReplyItem(action=MessageAction(label="↩️ 取消", text="開啟計算機"))
+                ])
+            ))
+
+        elif user_message == "生命值減半":
+            if user_id in user_duels and user_duels[user_id].get("target"):
+                target = user_duels[user_id]["target"]
+                user_duels[user_id][target] = math.ceil(user_duels[user_id][target] / 2)
+                p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
+                reply_messages.append(TextMessage(text=f"🩸 【血量更新】\n我方 LP: {p1}\n對方 LP: {p2}", quick_reply=get_duel_menu()))
+            else:
+                reply_messages.append(TextMessage(text="❌ 請先點擊「👈 調整我方」或「👉 調整對方」！", quick_reply=get_duel_menu()))
+
+        elif match := re.match(r'^([+-])\s*(\d+)$', user_message):
+            if user_id in user_duels and user_duels[user_id].get("target"):
+                target = user_duels[user_id]["target"]
+                operator, amount = match.group(1), int(match.group(2))
+                if operator == '+': user_duels[user_id][target] += amount
+                else: user_duels[user_id][target] -= amount
                 
-            elif user_message in ["決鬥開始", "重新決鬥"]:
-                user_duels[user_id] = {"我方": 8000, "對方": 8000, "target": None}
-                reply_messages.append(TextMessage(text="⚔️ 決鬥開始！ ⚔️\n➖➖➖➖➖➖\n我方 LP: 8000\n對方 LP: 8000", quick_reply=get_duel_menu()))
-
-            elif user_message in ["我方投降", "對方投降", "我方特殊勝利", "對方特殊勝利"]:
-                if user_id in user_duels:
-                    if "投降" in user_message:
-                        loser = "我方" if "我方" in user_message else "對方"
-                        winner = "對方" if loser == "我方" else "我方"
-                        reply_messages.append(TextMessage(text=f"🏳️ {loser} 選擇了投降，本局由 {winner} 獲勝！"))
-                    else:
-                        winner = "我方" if "我方" in user_message else "對方"
-                        reply_messages.append(TextMessage(text=f"✨ 達成特殊勝利條件！\n🏆 恭喜 {winner} 贏得本局決鬥！"))
+                p1, p2 = user_duels[user_id]["我方"], user_duels[user_id]["對方"]
+                text = f"🩸 【血量更新】 ({target} {operator}{amount})\n我方 LP: {p1}\n對方 LP: {p2}"
+                
+                if p1 <= 0 or p2 <= 0:
+                    text += "\n➖➖➖➖➖➖\n🏆 決鬥結束 🏆\n"
+                    if p1 <= 0 and p2 <= 0: text += "雙方血量歸零，平局 (DRAW)！"
+                    elif p1 <= 0: text += "我方血量歸零，對方獲勝！"
+                    else: text += "對方血量歸零，我方獲勝！"
                     del user_duels[user_id]
-                else: reply_messages.append(TextMessage(text="❌ 決鬥尚未開始！"))
-
-            # --- 隨機工具 ---
-            elif match := re.match(r'^擲骰子\s*(\d+)?', user_message):
-                times = min(int(match.group(1)) if match.group(1) else 1, 20)
-                results = [random.randint(1, 6) for _ in range(times)]
-                text = f"🎲 擲骰子 {times} 次的結果：\n" + "\n".join([f"第 {i+1} 次：【 {res} 】" for i, res in enumerate(results)]) + f"\n\n✨ 總和：{sum(results)}"
-                reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu() if user_id in user_duels else None))
-
-            elif match := re.match(r'^擲硬幣\s*(\d+)?', user_message):
-                times = min(int(match.group(1)) if match.group(1) else 1, 20)
-                results = [random.choice(["正面 🌕", "反面 🌑"]) for _ in range(times)]
-                text = f"🪙 擲硬幣 {times} 次的結果：\n" + "\n".join([f"第 {i+1} 次：{res}" for i, res in enumerate(results)])
-                reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu() if user_id in user_duels else None))
-
-            elif user_message == "隨機工具":
-                reply_messages.append(TextMessage(
-                    text="🎲 請選擇隨機工具，或自行輸入(例: 擲骰子 5)：",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(label="🎲 擲骰子 1次", text="擲骰子 1")),
-                        QuickReplyItem(action=MessageAction(label="🪙 擲硬幣 1次", text="擲硬幣 1")),
-                        QuickReplyItem(action=MessageAction(label="🎲 擲骰子 3次", text="擲骰子 3"))
-                    ])
-                ))
-
-            # --- 全新牌組管理主選單 ---
-            elif user_message == "我的牌組":
-                reply_messages.append(TextMessage(
-                    text="🗂️ 【牌組管理系統】\n請點擊下方快捷鍵操作：",
-                    quick_reply=QuickReply(items=[
-                        QuickReplyItem(action=MessageAction(label="➕ 建立牌組", text="流程_建立牌組")),
-                        QuickReplyItem(action=MessageAction(label="📝 編輯牌組", text="流程_編輯牌組")),
-                        QuickReplyItem(action=MessageAction(label="🔍 查看牌組清單", text="流程_查看牌組")),
-                        QuickReplyItem(action=MessageAction(label="🗑️ 刪除牌組", text="流程_刪除牌組"))
-                    ])
-                ))
-
-            # --- 牌組流程觸發 ---
-            elif user_message == "流程_建立牌組":
-                user_states[user_id] = {"state": "WAIT_CREATE_DECK", "data": {}}
-                reply_messages.append(TextMessage(text="📝 請直接輸入你要建立的「牌組名稱」\n(例如：白龍、閃刀姬)：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-
-            elif user_message == "流程_編輯牌組":
-                if not user_decks[user_id]:
-                    reply_messages.append(TextMessage(text="🗂️ 你目前還沒有建立任何牌組喔！\n請先點擊「我的牌組」>「建立牌組」。"))
+                    reply_messages.append(TextMessage(text=text))
                 else:
-                    decks_str = "\n".join([f"▪️ {d}" for d in user_decks[user_id].keys()])
-                    user_states[user_id] = {"state": "WAIT_EDIT_TARGET", "data": {}}
-                    reply_messages.append(TextMessage(text=f"🗂️ 你的牌組列表：\n{decks_str}\n\n📝 請直接輸入你要編輯的「牌組名稱」：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-
-            elif user_message == "流程_查看牌組":
-                if not user_decks[user_id]:
-                    reply_messages.append(TextMessage(text="🗂️ 目前沒有牌組！"))
+                    reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu()))
+            else:
+                reply_messages.append(TextMessage(text="❌ 請先選擇目標！", quick_reply=get_duel_menu()))
+
+        elif user_message == "決鬥結算選單":
+            reply_messages.append(TextMessage(
+                text="⚙️ 請選擇結算方式或重新開始：",
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(label="🏳️ 我方投降", text="我方投降")),
+                    QuickReplyItem(action=MessageAction(label="🏳️ 對方投降", text="對方投降")),
+                    QuickReplyItem(action=MessageAction(label="✨ 我方特殊勝利", text="我方特殊勝利")),
+                    QuickReplyItem(action=MessageAction(label="🔄 重新決鬥 (重置)", text="決鬥開始"))
+                ])
+            ))
+            
+        elif user_message in ["決鬥開始", "重新決鬥"]:
+            user_duels[user_id] = DuelRecord()
+            reply_messages.append(TextMessage(text="⚔️ 決鬥開始！ ⚔️\n➖➖➖➖➖➖\n我方 LP: 8000\n對方 LP: 8000", quick_reply=get_duel_menu()))
+
+        elif user_message in ["我方投降", "對方投降", "我方特殊勝利", "對方特殊勝利"]:
+            if user_id in user_duels:
+                if "投降" in user_message:
+                    loser = "我方" if "我方" in user_message else "對方"
+                    winner = "對方" if loser == "我方" else "我方"
+                    reply_messages.append(TextMessage(text=f"🏳️ {loser} 選擇了投降，本局由 {winner} 獲勝！"))
                 else:
-                    decks_str = "\n".join([f"▪️ {d}" for d in user_decks[user_id].keys()])
-                    reply_messages.append(TextMessage(text=f"🗂️ 你的牌組總覽：\n{decks_str}\n\n💡 若要查看詳細卡表，請點擊「我的牌組」>「編輯牌組」進入操作！"))
+                    winner = "我方" if "我方" in user_message else "對方"
+                    reply_messages.append(TextMessage(text=f"✨ 達成特殊勝利條件！\n🏆 恭喜 {winner} 贏得本局決鬥！"))
+                del user_duels[user_id]
+            else: reply_messages.append(TextMessage(text="❌ 決鬥尚未開始！"))
+
+        # --- 隨機工具 ---
+        elif match := re.match(r'^擲骰子\s*(\d+)?', user_message):
+            times = min(int(match.group(1)) if match.group(1) else 1, 20)
+            results = [random.randint(1, 6) for _ in range(times)]
+            text = f"🎲 擲骰子 {times} 次的結果：\n" + "\n".join([f"第 {i+1} 次：【 {res} 】" for i, res in enumerate(results)]) + f"\n\n✨ 總和：{sum(results)}"
+            reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu() if user_id in user_duels else None))
+
+        elif match := re.match(r'^擲硬幣\s*(\d+)?', user_message):
+            times = min(int(match.group(1)) if match.group(1) else 1, 20)
+            results = [random.choice(["正面 🌕", "反面 🌑"]) for _ in range(times)]
+            text = f"🪙 擲硬幣 {times} 次的結果：\n" + "\n".join([f"第 {i+1} 次：{res}" for i, res in enumerate(results)])
+            reply_messages.append(TextMessage(text=text, quick_reply=get_duel_menu() if user_id in user_duels else None))
+
+        elif user_message == "隨機工具":
+            reply_messages.append(TextMessage(
+                text="🎲 請選擇隨機工具，或自行輸入(例: 擲骰子 5)：",
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(label="🎲 擲骰子 1次", text="擲骰子 1")),
+                    QuickReplyItem(action=MessageAction(label="🪙 擲硬幣 1次", text="擲硬幣 1")),
+                    QuickReplyItem(action=MessageAction(label="🎲 擲骰子 3次", text="擲骰子 3"))
+                ])
+            ))
+
+        # --- 全新牌組管理主選單 ---
+        elif user_message == "我的牌組":
+            reply_messages.append(TextMessage(
+                text="🗂️ 【牌組管理系統】\n請點擊下方快捷鍵操作：",
+                quick_reply=QuickReply(items=[
+                    QuickReplyItem(action=MessageAction(label="➕ 建立牌組", text="流程_建立牌組")),
+                    QuickReplyItem(action=MessageAction(label="📝 編輯牌組", text="流程_編輯牌組")),
+                    QuickReplyItem(action=MessageAction(label="🔍 查看牌組清單", text="流程_查看牌組")),
+                    QuickReplyItem(action=MessageAction(label="🗑️ 刪除牌組", text="流程_刪除牌組"))
+                ])
+            ))
+
+        # --- 牌組流程觸發 ---
+        elif user_message == "流程_建立牌組":
+            user_states[user_id] = StateRecord("WAIT_CREATE_DECK")
+            reply_messages.append(TextMessage(text="📝 請直接輸入你要建立的「牌組名稱」\n(例如：白龍、閃刀姬)：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
+
+        elif user_message == "流程_編輯牌組":
+            if not decks:
+                reply_messages.append(TextMessage(text="🗂️ 你目前還沒有建立任何牌組喔！\n請先點擊「我的牌組」>「建立牌組」。"))
+            else:
+                decks_str = "\n".join([f"▪️ {d}" for d in decks.keys()])
+                user_states[user_id] = StateRecord("WAIT_EDIT_TARGET")
+                reply_messages.append(TextMessage(text=f"🗂️ 你的牌組列表：\n{decks_str}\n\n📝 請直接輸入你要編輯的「牌組名稱」：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
 
-            elif user_message == "流程_刪除牌組":
-                if not user_decks[user_id]:
-                    reply_messages.append(TextMessage(text="🗂️ 目前沒有任何牌組可以刪除！"))
-                else:
-                    decks_str = "\n".join([f"▪️ {d}" for d in user_decks[user_id].keys()])
-                    user_states[user_id] = {"state": "WAIT_DELETE_TARGET", "data": {}}
-                    reply_messages.append(TextMessage(text=f"🗂️ 你的牌組列表：\n{decks_str}\n\n⚠️ 請直接輸入你要【刪除】的牌組名稱：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
-
-            # --- 編輯牌組的快捷指令處理 (由 QuickReply 觸發) ---
-            elif match := re.match(r'^準備(新增主牌|新增額外|新增備牌|刪除卡片) (.+)$', user_message):
-                action_map = {"新增主牌": "main", "新增額外": "extra", "新增備牌": "side", "刪除卡片": "remove"}
-                action_str, deck_name = match.group(1), match.group(2)
-                
-                user_states[user_id] = {"state": "WAIT_ADD_CARD" if "新增" in action_str else "WAIT_REMOVE_CARD", 
-                                        "data": {"type": action_map[action_str], "deck_name": deck_name}}
-                
+        elif user_message == "流程_查看牌組":
+            if not decks:
+                reply_messages.append(TextMessage(text="🗂️ 目前沒有牌組！"))
+            else:
+                decks_str = "\n".join([f"▪️ {d}" for d in decks.keys()])
+                reply_messages.append(TextMessage(text=f"🗂️ 你的牌組總覽：\n{decks_str}\n\n💡 若要查看詳細卡表，請點擊「我的牌組」>「編輯牌組」進入操作！"))
+
+        elif user_message == "流程_刪除牌組":
+            if not decks:
+                reply_messages.append(TextMessage(text="🗂️ 目前沒有任何牌組可以刪除！"))
+            else:
+                decks_str = "\n".join([f"▪️ {d}" for d in decks.keys()])
+                user_states[user_id] = StateRecord("WAIT_DELETE_TARGET")
+                reply_messages.append(TextMessage(text=f"🗂️ 你的牌組列表：\n{decks_str}\n\n⚠️ 請直接輸入你要【刪除】的牌組名稱：", quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])))
+
+        # --- 編輯牌組的快捷指令處理 (由 QuickReply 觸發) ---
+        elif match := re.match(r'^準備(新增主牌|新增額外|新增備牌|刪除卡片) (.+)$', user_message):
+            action_map = {"新增主牌": "main", "新增額外": "extra", "新增備牌": "side", "刪除卡片": "remove"}
+            action_str, deck_name = match.group(1), match.group(2)
+            
+            user_states[user_id] = StateRecord("WAIT_ADD_CARD" if "新增" in action_str else "WAIT_REMOVE_CARD",
+                                                {"type": action_map[action_str], "deck_name": deck_name})
+            
+            reply_messages.append(TextMessage(
+                text=f"📝 準備【{action_str}】至牌組：{deck_name}\n\n請直接輸入卡名與數量 (不同卡片請用空格隔開)。\n範例：『青眼白龍*3 融合*1』",
+                quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])
+            ))
+
+        elif match := re.match(r'^準備匯入牌組 (.+)$', user_message):
+            deck_name = match.group(1)
+            if deck_name not in decks:
+                reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】"))
+            else:
+                user_states[user_id] = StateRecord("WAIT_IMPORT_DECK", {"deck_name": deck_name})
                 reply_messages.append(TextMessage(
-                    text=f"📝 準備【{action_str}】至牌組：{deck_name}\n\n請直接輸入卡名與數量 (不同卡片請用空格隔開)。\n範例：『青眼白龍*3 融合*1』",
+                    text=f"📥 準備匯入整副牌組至：{deck_name}\n⚠️ 會覆蓋目前的卡表！\n\n請直接貼上卡表，或傳送 .ydk 檔案。\n範例：\n主牌組\n3 灰流麗\n青眼白龍*3\n額外牌組\n青眼究極龍 x1",
                     quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))])
                 ))
 
-            elif match := re.match(r'^(繼續編輯|查看特定牌組) (.+)$', user_message):
-                cmd_type, deck_name = match.group(1), match.group(2)
-                if deck_name not in user_decks[user_id]:
-                    reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】"))
+        elif match := re.match(r'^(繼續編輯|查看特定牌組) (.+)$', user_message):
+            cmd_type, deck_name = match.group(1), match.group(2)
+            if deck_name not in decks:
+                reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{deck_name}】"))
+            else:
+                if cmd_type == "繼續編輯":
+                    reply_messages.append(TextMessage(
+                        text=f"🎯 操作牌組：【{deck_name}】",
+                        quick_reply=QuickReply(items=[
+                            QuickReplyItem(action=MessageAction(label="➕ 新增主牌", text=f"準備新增主牌 {deck_name}")),
+                            QuickReplyItem(action=MessageAction(label="➕ 新增額外", text=f"準備新增額外 {deck_name}")),
+                            QuickReplyItem(action=MessageAction(label="➕ 新增備牌", text=f"準備新增備牌 {deck_name}")),
+                            QuickReplyItem(action=MessageAction(label="🗑️ 刪除卡片", text=f"準備刪除卡片 {deck_name}")),
+                            QuickReplyItem(action=MessageAction(label="📥 匯入整副", text=f"準備匯入牌組 {deck_name}")),
+                            QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
+                        ])
+                    ))
+                else: # 查看特定牌組
+                    deck_data = decks[deck_name]
+                    text = f"🗂️ 【{deck_name}】完整卡表\n➖➖➖➖➖➖\n"
+                    for dt, dt_tw in [("main", "主牌組"), ("extra", "額外牌組"), ("side", "備牌")]:
+                        total = deck_data.section_total[dt]
+                        text += f"🔹 {dt_tw} ({total}張)：\n"
+                        if total == 0: text += "(空)\n"
+                        for c_name, c_cnt in deck_data[dt].items(): text += f" - {c_name} * {c_cnt}\n"
+                        text += "\n"
+                    if violations := banlist.violations(deck_data):
+                        text += f"⚠️ 不符合禁卡表 ({banlist.current_version})：\n"
+                        text += "\n".join(f" - {n}：{c}張 ({LIMIT_TW[a]}，最多{a}張)" for n, c, a in violations)
+                    reply_messages.append(TextMessage(text=text.strip(), quick_reply=QuickReply(items=[
+                        QuickReplyItem(action=MessageAction(label="🔙 回到編輯", text=f"繼續編輯 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="🃏 抽起手", text=f"抽起手 {deck_name}")),
+                        QuickReplyItem(action=MessageAction(label="🎴 起手機率", text=f"起手機率 {deck_name}"))
+                    ])))
+
+        # --- 洗牌抽起手 / 起手機率 (例：起手機率 白龍 展開=青眼白龍,融合 手坑=灰流麗) ---
+        elif match := re.match(r'^(抽起手|起手機率) (.+)$', user_message):
+            cmd_type, rest = match.group(1), match.group(2)
+            deck_name = next((d for d in sorted(decks, key=len, reverse=True) if rest == d or rest.startswith(d + " ")), None)
+            if deck_name is None:
+                reply_messages.append(TextMessage(text=f"❌ 找不到牌組【{rest}】"))
+            # 抽起手抽 5 張；起手機率的後攻 6 張在牌組不足時由 opening_odds 自己算成 0
+            elif decks[deck_name].section_total["main"] < HAND_SIZES[0]:
+                reply_messages.append(TextMessage(text=f"❌ 【{deck_name}】主牌組不到 {HAND_SIZES[0]} 張，無法計算起手！"))
+            elif cmd_type == "抽起手":
+                hand = draw_hand(decks[deck_name])
+                text = f"🃏 【{deck_name}】洗牌後的起手 {len(hand)} 張：\n" + "\n".join(f"{i + 1}. {c}" for i, c in enumerate(hand))
+                reply_messages.append(TextMessage(text=text, quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="🔄 再抽一次", text=f"抽起手 {deck_name}"))])))
+            else:
+                line.show_loading(user_id, 10)
+                deck_data = decks[deck_name]
+                def resolve_name(n):
+                    if n in deck_data["main"] or not card_db: return n
+                    card, _ = card_db.resolve(n)
+                    return card_name(card) if card else n
+                groups = parse_groups(rest[len(deck_name):], resolve_name)
+                if groups:
+                    result = opening_odds(deck_key(deck_data), groups, SIM_TRIALS)
+                    text = format_odds(deck_name, result, SIM_TRIALS)
                 else:
-                    if cmd_type == "繼續編輯":
-                        reply_messages.append(TextMessage(
-                            text=f"🎯 操作牌組：【{deck_name}】",
-                            quick_reply=QuickReply(items=[
-                                QuickReplyItem(action=MessageAction(label="➕ 新增主牌", text=f"準備新增主牌 {deck_name}")),
-                                QuickReplyItem(action=MessageAction(label="➕ 新增額外", text=f"準備新增額外 {deck_name}")),
-                                QuickReplyItem(action=MessageAction(label="➕ 新增備牌", text=f"準備新增備牌 {deck_name}")),
-                                QuickReplyItem(action=MessageAction(label="🗑️ 刪除卡片", text=f"準備刪除卡片 {deck_name}")),
-                                QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
-                            ])
-                        ))
-                    else: # 查看特定牌組
-                        deck_data = user_decks[user_id][deck_name]
-                        text = f"🗂️ 【{deck_name}】完整卡表\n➖➖➖➖➖➖\n"
-                        for dt, dt_tw in [("main", "主牌組"), ("extra", "額外牌組"), ("side", "備牌")]:
-                            total = sum(deck_data[dt].values())
-                            text += f"🔹 {dt_tw} ({total}張)：\n"
-                            if total == 0: text += "(空)\n"
-                            for c_name, c_cnt in deck_data[dt].items(): text += f" - {c_name} * {c_cnt}\n"
-                            text += "\n"
-                        reply_messages.append(TextMessage(text=text.strip(), quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="🔙 回到編輯", text=f"繼續編輯 {deck_name}"))])))
-
-            # --- Gemini Fallback ---
+                    # 沒指定條件：列出張數最多的卡各自的上手率
+                    top = sorted(deck_data["main"].items(), key=lambda x: -x[1])[:15]
+                    result = opening_odds(deck_key(deck_data), tuple((n, (n,), 1) for n, _ in top), SIM_TRIALS, joint=False)
+                    text = format_odds(deck_name, result, SIM_TRIALS)
+                    text += f"\n\n💡 可自訂條件，例：\n起手機率 {deck_name} 展開=卡A,卡B 手坑=卡C、卡D"
+                reply_messages.append(TextMessage(text=text[:5000]))
+
+        # --- 本地禁卡表 (沒有資料時交給下面的 Gemini 查詢) ---
+        elif banlist and BANLIST_QUERY.match(user_message):
+            reply_messages.extend(pack_messages([banlist.format()]))
+
+        elif banlist and (match := BANLIST_DIFF.match(user_message)):
+            # 「禁卡表比較」= 上一版 vs 最新版；「禁卡表比較 舊版」= 舊版 vs 最新版；「禁卡表比較 舊版 新版」
+            new_ver = match.group(2) or banlist.current_version
+            old_ver = match.group(1) or banlist.previous_version(new_ver)
+            if old_ver not in banlist.versions or new_ver not in banlist.versions:
+                reply_messages.append(TextMessage(text=f"❌ 找不到禁卡表版本，目前有：{'、'.join(sorted(banlist.versions))}"))
             else:
-                try:
-                    line_bot_api.show_loading_animation(ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=15))
-                    response = client.models.generate_content(
-                        model=MODEL_ID, contents=user_message,
-                        config=types.GenerateContentConfig(tools=[{"google_search": {}}], system_instruction="你是一位專精「遊戲王 OCG 賽制」的裁判。2026年，嚴格根據最新環境回答。")
-                    )
-                    reply_messages.append(TextMessage(text=response.text))
-                except Exception as e:
-                    reply_messages.append(TextMessage(text=f"抱歉，系統思考時發生錯誤：{str(e)}"))
-
-        # 統一送出
-        if reply_messages:
-            line_bot_api.reply_message_with_http_info(ReplyMessageRequest(reply_token=event.reply_token, messages=reply_messages))
-
-@handler.add(MessageEvent, message=ImageMessageContent)
+                changes = banlist.diff(old_ver, new_ver)
+                text = f"📜 禁卡表 {old_ver} → {new_ver}\n➖➖➖➖➖➖\n"
+                text += "\n".join(f"▪️ {n}：{LIMIT_TW[a]} → {LIMIT_TW[b]}" for n, a, b in changes) if changes else "(沒有變動)"
+                affected = [(d, v) for d, deck in decks.items() if (v := banlist.violations(deck, new_ver))]
+                text += "\n\n🗂️ 你的牌組受影響：\n" if affected else "\n\n✅ 你的牌組都符合新禁卡表！"
+                for d, v in affected:
+                    text += f"【{d}】\n" + "\n".join(f" - {n}：{c}張 → 最多{a}張" for n, c, a in v) + "\n"
+                reply_messages.extend(pack_messages([text.strip()]))
+
+        # --- 本地卡片資料庫 (查得到就不必問 Gemini) ---
+        elif card_db and ((card := card_db.lookup(user_message)) or
+                          ((match := CARD_QUERY.match(user_message)) and (card := card_db.named(match.group("a") or match.group("b"))))):
+            reply_messages.append(TextMessage(text=format_card(card)))
+
+        # --- Gemini Fallback ---
+        else:
+            # 快取沒有才真的問 Gemini；同一題同時被問時只會打一次
+            def ask_gemini():
+                line.show_loading(user_id, 15)
+                context, local_hit = retriever.retrieve(user_message)
+                return judge.generate(build_prompt(user_message, context), grounded=not local_hit, label="text",
+                                      deadline=event.timestamp / 1000 + GEMINI_DEADLINE)
+            def answer():
+                # 回答裡有本地禁卡表的限制張數，禁卡表換版後不能再用舊答案
+                try: return [TextMessage(text=answer_cache.get_or_compute(user_message, ask_gemini, banlist.current_version if banlist else None))]
+                except Exception as e: return [TextMessage(text=gemini_error_text(e))]
+            reply_messages.extend(answer_within_deadline(user_id, event.timestamp, answer))
+
+    mark("route")
+
+    # 決鬥有變動才寫回存檔
+    duel_after = user_duels[user_id].to_dict() if user_id in user_duels else None
+    if duel_after != duel_before: deck_store.save_duel(user_id, duel_after)
+    mark("save")
+
+    # 統一送出
+    if reply_messages: reply(event.reply_token, reply_messages)
+
+def reply(reply_token, messages):
+    with stage("line_reply"): line.api.reply_message_with_http_info(ReplyMessageRequest(reply_token=reply_token, messages=messages))
+
+# --- 整副匯入：逐行解析、驗證後一次覆蓋牌組 ---
+def import_into_deck(user_id, deck_name, lines):
+    deck, notes, errors = import_deck(lines, card_db, banlist)
+    # 一行都沒成功就不覆蓋原本的牌組，也不離開匯入狀態，讓使用者直接重貼
+    if not any(deck.section_total.values()):
+        return TextMessage(text=format_import_failure(deck_name, errors)[:5000],
+                           quick_reply=QuickReply(items=[QuickReplyItem(action=MessageAction(label="❌ 取消", text="取消"))]))
+    deck_store.save_deck(user_id, deck_name, deck)
+    reset_state(user_id)
+    return TextMessage(
+        text=format_import_result(deck_name, deck, notes, errors)[:5000],
+        quick_reply=QuickReply(items=[
+            QuickReplyItem(action=MessageAction(label="🔙 繼續編輯此牌組", text=f"繼續編輯 {deck_name}")),
+            QuickReplyItem(action=MessageAction(label="🔍 查看此牌組", text=f"查看特定牌組 {deck_name}"))
+        ])
+    )
+
+@on_event(MessageEvent, message=FileMessageContent)
+def handle_file(event):
+    user_id = event.source.user_id
+    session = user_states.get(user_id)
+    if not session or session.state != "WAIT_IMPORT_DECK" or not event.message.file_name.lower().endswith(".ydk"): return
+    start_trace("deck_import", session.state)
+    with stage("blob_download"): content = line.blob.get_message_content(event.message.id)
+    message = import_into_deck(user_id, session.data["deck_name"], content.decode("utf-8-sig", errors="replace").splitlines())
+    mark("import")
+    reply(event.reply_token, [message])
+
+CARD_PROMPT = "請提供：1.【名稱】2.【效果】3.【系列】4.【推薦組法】5.【禁卡表】。"
+CARD_FOOTER = "💡 點擊「我的牌組」即可將卡片加入你的牌組中喔！"
+CARD_SEPARATOR = "====="
+
+@on_event(MessageEvent, message=ImageMessageContent)
 def handle_image(event):
-    message_id, user_id = event.message.id, event.source.user_id
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        try: line_bot_api.show_loading_animation(ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=30))
-        except: pass
-
-        blob_api = MessagingApiBlob(api_client)
-        img = Image.open(io.BytesIO(blob_api.get_message_content(message_id)))
-        
-        prompt = "請提供：1.【名稱】2.【效果】3.【系列】4.【推薦組法】5.【禁卡表】。結尾加上：『💡 點擊「我的牌組」即可將卡片加入你的牌組中喔！』"
+    # 馬上開始下載 + 縮圖，批次視窗只延後合併的 Gemini 請求；湊成一批後由 recognize_images 一次處理
+    if image_batcher.add(event, image_pool.submit(load_image, event)): line.show_loading(event.source.user_id, 30)
+
+# 在 image_pool 執行，這時候這批照片的 trace 還沒開始，耗時記在 image 底下
+def load_image(event):
+    with stage("blob_download", "image"): data = line.blob.get_message_content(event.message.id)
+    with stage("image_decode", "image"):
+        img, img_bytes, mime_type, card = prepare_image(data, IMAGE_MAX_EDGE, IMAGE_CROP_CARD, IMAGE_FORMAT, IMAGE_MAX_BYTES)
+        # 雜湊只算卡片範圍；找不到卡片外框就回傳 None，不查也不寫雜湊快取
+        return dhash(card) if card else None, img_bytes, mime_type
+
+# --- 一批照片：等各自的下載 -> 查雜湊快取 -> 沒看過的合併成一次 Gemini 請求 -> 一則回覆 ---
+def recognize_images(events, futures):
+    start_trace("image_scan" if len(events) == 1 else "image_batch")
+    try: recognize_batch(events, futures)
+    finally: finish_trace(SLOW_EVENT_SECONDS, SLOW_EVENT_SAMPLE)
+
+def recognize_batch(events, futures):
+    results, todo = [None] * len(events), []
+    ban_version = banlist.current_version if banlist else None
+    for i, f in enumerate(futures):
         try:
-            response = client.models.generate_content(model=MODEL_ID, contents=[prompt, img], config=types.GenerateContentConfig(tools=[{"google_search": {}}], system_instruction="你是一位專精「遊戲王 OCG 賽制」的裁判。現在是2026年。"))
-            reply_text = response.text
+            with stage("image_wait"): img_hash, img_bytes, mime_type = f.result()
         except Exception as e:
-            reply_text = f"辨識失敗，錯誤：{str(e)}"
-        line_bot_api.reply_message_with_http_info(ReplyMessageRequest(reply_token=event.reply_token, messages=[TextMessage(text=reply_text)]))
+            results[i] = f"圖片下載失敗，錯誤：{str(e)}"
+            continue
+        # 熱門卡片常被重複拍照，雜湊夠接近就直接用之前的辨識結果
+        results[i] = image_index.lookup(img_hash, ban_version) if img_hash is not None else None
+        if results[i] is None: todo.append((i, img_hash, types.Part.from_bytes(data=img_bytes, mime_type=mime_type)))
+
+    deadline = events[0].timestamp / 1000 + GEMINI_DEADLINE
+    def answer():
+        if todo: recognize_todo(todo, results, deadline, ban_version)
+        if len(results) == 1: texts = [f"{results[0]}\n\n{CARD_FOOTER}"]
+        else: texts = [f"📷 第 {i + 1} 張\n{r}" for i, r in enumerate(results)] + [CARD_FOOTER]
+        return pack_messages(texts)
+    messages = answer_within_deadline(events[0].source.user_id, events[0].timestamp, answer)
+    reply(events[0].reply_token, messages)
+
+# --- 辨識結果寫回 results (按照片順序)，分段正確的才寫進雜湊快取 ---
+def recognize_todo(todo, results, deadline, ban_version=None):
+    try:
+        answers, raw = ask_cards(todo, deadline)
+        if len(answers) == len(todo):
+            for (i, img_hash, _), answer in zip(todo, answers):
+                results[i] = answer
+                if answer and img_hash is not None: image_index.add(img_hash, answer, ban_version)
+        else:
+            # 模型沒照格式分段就整段回覆，不寫進快取
+            results[todo[0][0]] = raw
+            for i, _, _ in todo[1:]: results[i] = "(見上方合併結果)"
+    except Exception as e:
+        for i, _, _ in todo: results[i] = gemini_error_text(e, "辨識失敗")
+
+# --- 沒看過的照片：有卡片資料庫時先只認卡名 (不搜尋、輸出很短)，全部對得上本地資料就用本地資料回答；
+#     有任何一張認不出來 (或沒有資料庫) 才把照片連同 google_search 一起送出 ---
+def ask_cards(todo, deadline=None):
+    cards = identify_cards([part for _, _, part in todo], deadline) if card_db else None
+    if cards and all(cards):
+        ban_version = banlist.current_version if banlist else None
+        contexts = [retriever.card_context(card, ban_version) for card in cards]
+        if len(cards) == 1: prompt = build_prompt(CARD_PROMPT, contexts[0])
+        else: prompt = (f"以下共 {len(cards)} 張卡片，請依順序分別回答，每張之間只用一行『{CARD_SEPARATOR}』分隔。每張{CARD_PROMPT}\n\n"
+                        + "\n\n".join(f"【第 {n} 張 本地資料】\n{c}" for n, c in enumerate(contexts, 1)))
+        text = judge.generate(prompt, grounded=False, label="image", deadline=deadline)
+    else:
+        if len(todo) == 1: prompt = CARD_PROMPT
+        else: prompt = f"以下共 {len(todo)} 張卡片照片，請依照片順序分別回答，每張之間只用一行『{CARD_SEPARATOR}』分隔。每張{CARD_PROMPT}"
+        text = judge.generate([prompt] + [part for _, _, part in todo], grounded=True, label="image", deadline=deadline)
+    answers = [a.strip() for a in (text or "").split(CARD_SEPARATOR)] if len(todo) > 1 else [text]
+    return answers, text
+
+LIST_MARK = re.compile(r'^\s*(?:\d+\s*[.、)）:：]|[-・•*])\s*')
+IDENTIFY_PROMPT = "請辨識每張照片中的遊戲王卡片，依照片順序每張一行，只寫卡片名稱 (看不出來就寫「?」)，不要其他文字。"
+
+def identify_cards(parts, deadline=None):
+    try: text = judge.generate([IDENTIFY_PROMPT] + parts, grounded=False, label="identify", deadline=deadline)
+    except Exception as e:
+        logger.info("卡名辨識失敗，改用搜尋：%s", e)
+        return None
+    names = [LIST_MARK.sub("", n).strip() for n in (text or "").splitlines() if n.strip()]
+    if len(names) != len(parts): return None
+    return [card_db.resolve(n)[0] if n not in ("?", "？") else None for n in names]
+
+# ==========================================
+# 回覆期限：reply token 只在收到訊息後一段時間內有效
+# 答案在 REPLY_DEADLINE 內算完就直接回覆；來不及就先回「稍後送達」，算完再用 push API 補送，不會因為 token 過期而整個遺失
+# ==========================================
+LATE_NOTICE = "⏳ 這題需要多想一下，答案好了會馬上傳給你！"
+
+def answer_within_deadline(user_id, timestamp_ms, compute):
+    future = gemini_pool.submit(contextvars.copy_context().run, compute)
+    # 等答案時把 worker 讓出來，其他使用者的事件不必跟著等
+    try:
+        with dispatcher.blocking() if dispatcher else contextlib.nullcontext():
+            return future.result(timeout=max(0.0, timestamp_ms / 1000 + REPLY_DEADLINE - time.time()))
+    except FutureTimeout:
+        future.add_done_callback(lambda f: push_late_answer(user_id, f))
+        return [TextMessage(text=LATE_NOTICE)]
+
+def push_late_answer(user_id, future):
+    try:
+        with stage("line_push"): line.api.push_message_with_http_info(PushMessageRequest(to=user_id, messages=future.result()))
+    except Exception: logger.exception("補送答案失敗 (user=%s)", user_id)
+
+def gemini_error_text(e, prefix="抱歉，系統思考時發生錯誤"):
+    if isinstance(e, GateTimeout): return "🙏 現在詢問的人太多了，請稍後再問一次！"
+    if getattr(e, "code", None) == 429: return "🙏 Gemini 使用額度暫時用完了，請過幾分鐘再試！"
+    return f"{prefix}：{str(e)}"
+
+# LINE 一次回覆最多 5 則、每則 5000 字，超過就合併/截斷
+def pack_messages(texts, max_messages=5, max_chars=5000):
+    packed = []
+    for text in texts:
+        if len(packed) < max_messages: packed.append(text)
+        else: packed[-1] += "\n\n" + text
+    return [TextMessage(text=t if len(t) <= max_chars else t[:max_chars - 1] + "…") for t in packed]
+
+image_batcher = ImageBatcher(recognize_images, IMAGE_BATCH_WINDOW, IMAGE_SET_TIMEOUT, IMAGE_BATCH_MAX)
+
+# ==========================================
+# 開機 import 耗時表：LAZY_STARTUP 時延後的部分列在「延後載入」，載入後的耗時可在 /stats 的 startup 查看
+# ==========================================
+if not LAZY_STARTUP: lazy.load_all()
+logger.info("啟動 %.0fms：%s%s", (time.perf_counter() - BOOT_STARTED) * 1000, lazy.report(),
+            f"；延後載入：{', '.join(lazy.pending())}" if lazy.pending() else "")
+if LAZY_STARTUP and STARTUP_WARMUP: lazy.warmup(WARMUP_DELAY)
 
 if __name__ == "__main__":
     print(" 遊戲王啟動中...")
@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from gemini_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+LIMIT_KEYS = {"forbidden": 0, "limited": 1, "semi_limited": 2, "unlimited": 3}
+LIMIT_TW = {0: "禁止", 1: "限制", 2: "準限制", 3: "無限制"}
+
+# ==========================================
+# 本地禁卡表 (依版本保存)
+# BANLIST_DIR 內每個 JSON 檔是一個版本，版本號用字串排序 (建議 2026-07 這種格式)：
+#   完整版：{"version": "2026-07", "forbidden": [...], "limited": [...], "semi_limited": [...]}
+#   差異版：{"version": "2026-10", "base": "2026-07", "limited": [...], "unlimited": [...]}
+#           (以 base 為底，只列出有變動的卡；unlimited 代表解除限制)
+# 只會讀新增或修改過的檔案，被刪掉的檔案對應的版本也會拿掉；每個版本都是 {卡片 key: 可放張數} 的 dict，查詢 O(1)
+# 有卡片資料庫時 key 是卡片 id：禁卡表用英文/日文卡名寫，牌組裡存中文名也查得到；資料庫沒有的卡才用正規化卡名
+# ==========================================
+class BanList:
+    def __init__(self, folder="banlists", refresh_interval=60, card_db=None):
+        self.folder = folder
+        self.refresh_interval = refresh_interval
+        self.card_db = card_db
+        self.versions = {}    # version -> {key: count}
+        self.names = {}       # key -> 顯示用卡名
+        self._raw = {}        # version -> 原始檔內容 (差異版需要依 base 重算)
+        self._files = {}      # 檔案路徑 -> (mtime, version)
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self._checked < self.refresh_interval: return False
+        with self._lock:
+            self._checked = time.monotonic()
+            entries = [e for e in os.scandir(self.folder) if e.name.endswith(".json")] if os.path.isdir(self.folder) else []
+            changed = False
+            # 檔案被刪掉 (或整個資料夾不見了)：拿掉它的版本
+            present = {e.path for e in entries}
+            for path in [p for p in self._files if p not in present]:
+                self._raw.pop(self._files.pop(path)[1], None)
+                changed = True
+            for entry in entries:
+                mtime = entry.stat().st_mtime
+                if self._files.get(entry.path, (None,))[0] == mtime: continue
+                try:
+                    with open(entry.path, encoding="utf-8") as f: raw = json.load(f)
+                    version = str(raw["version"])
+                except (OSError, ValueError, KeyError):
+                    logger.exception("禁卡表檔案讀取失敗：%s", entry.path)
+                    continue
+                # 同一個檔案改了版本號，舊版本要一起拿掉
+                if entry.path in self._files: self._raw.pop(self._files[entry.path][1], None)
+                self._raw[version] = raw
+                self._files[entry.path] = (mtime, version)
+                changed = True
+            if changed: self._rebuild()
+            return changed
+
+    def _key(self, name):
+        card = self.card_db.lookup(name) if self.card_db else None
+        return card["id"] if card else normalize_query(name)
+
+    def _rebuild(self):
+        versions, names = {}, {}
+        def build(version, seen=()):
+            if version in versions: return versions[version]
+            raw = self._raw[version]
+            base = raw.get("base")
+            table = dict(build(base, seen + (version,))) if base in self._raw and base not in seen else {}
+            for key, count in LIMIT_KEYS.items():
+                for name in raw.get(key, []):
+                    card_key = self._key(name)
+                    names[card_key] = name
+                    if count >= 3: table.pop(card_key, None)
+                    else: table[card_key] = count
+            versions[version] = table
+            return table
+        for version in self._raw: build(version)
+        self.versions, self.names = versions, names
+
+    @property
+    def current_version(self):
+        self.refresh()
+        return max(self.versions) if self.versions else None
+
+    def __bool__(self):
+        return bool(self.versions)
+
+    # 依禁卡表可放幾張 (不在表上 -> 3)
+    def limit(self, name, version=None):
+        version = version or self.current_version
+        if version is None: return 3
+        return self.versions[version].get(self._key(name), 3)
+
+    # 牌組內超過限制的卡：[(卡名, 現有張數, 可放張數)]
+    def violations(self, deck, version=None):
+        version = version or self.current_version
+        table = self.versions.get(version, {})
+        totals = {}
+        for section in ("main", "extra", "side"):
+            for name, count in deck.get(section, {}).items(): totals[name] = totals.get(name, 0) + count
+        result = []
+        for name, count in totals.items():
+            allowed = table.get(self._key(name), 3)
+            if count > allowed: result.append((name, count, allowed))
+        return result
+
+    # 兩個版本之間的差異：[(卡名, 舊張數, 新張數)]
+    def diff(self, old, new):
+        a, b = self.versions.get(old, {}), self.versions.get(new, {})
+        return sorted((self.names.get(key, key), a.get(key, 3), b.get(key, 3))
+                      for key in set(a) | set(b) if a.get(key, 3) != b.get(key, 3))
+
+    def previous_version(self, version):
+        older = [v for v in self.versions if v < version]
+        return max(older) if older else None
+
+    def format(self, version=None):
+        version = version or self.current_version
+        table = self.versions.get(version, {})
+        text = f"📜 禁卡表 ({version})\n➖➖➖➖➖➖\n"
+        for count in (0, 1, 2):
+            names = sorted(self.names.get(n, n) for n, c in table.items() if c == count)
+            text += f"🔹 {LIMIT_TW[count]} ({len(names)}張)：\n" + ("\n".join(f" - {n}" for n in names) if names else "(無)") + "\n\n"
+        return text.strip()
@@ -0,0 +1,149 @@
+# ==========================================
+# 冷啟動：從「啟動 process」到「/callback 第一次回 200」要多久
+# 每一輪都開一個全新的 python process 跑 app (模擬 scale-to-zero 的容器被喚醒)，
+# 一開始就不斷送有簽章的 webhook，連得上就算開始服務，量：
+#   import：import app 花的時間 (app 自己印的耗時表也會一起列出)
+#   首次 OK：從 spawn 到第一個 200；首次回覆：從 spawn 到假 Messaging API 收到回覆
+#   熱請求：同一個 process 的第二個 webhook，比較載入完之後有沒有變慢
+#   python bench/bench_cold_start.py --runs 5
+#   python bench/bench_cold_start.py --modes eager,lazy --callback async --event verify
+# 模式：eager = 預設 (import 時全部載入)、lazy = LAZY_STARTUP=1 不預熱、warm = LAZY_STARTUP=1 + 背景預熱
+# 事件：text = 一則「擲骰子」(需要回覆)、verify = LINE 後台「驗證」送的空 webhook
+# ==========================================
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+from replay_load import CHANNEL_SECRET, start_stub, json_reply, sign
+
+MODES = {"eager": {"LAZY_STARTUP": "0"}, "lazy": {"LAZY_STARTUP": "1", "STARTUP_WARMUP": "0"},
+         "warm": {"LAZY_STARTUP": "1", "STARTUP_WARMUP": "1"}}
+
+# --- 子 process：import app 後用 werkzeug 開始服務，LINE API 指到父 process 的假服務 ---
+def serve(args):
+    started = time.perf_counter()
+    import app
+    import_ms = (time.perf_counter() - started) * 1000
+    import lazy
+    import logging
+    from line_clients import LineClients
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    boot = lazy.snapshot_stats()
+    app.line = lazy.Lazy(lambda: LineClients(app.Configuration(access_token="bench", host=args.line_url)), "line", label="LineClients()")
+    server = make_server("127.0.0.1", args.port, app.app, threaded=True)
+    print(json.dumps({"import_ms": import_ms, "boot": boot}, ensure_ascii=False), flush=True)
+    server.serve_forever()
+
+# --- 父 process ---
+class Replies:
+    def __init__(self):
+        self.seen, self.cond = {}, threading.Condition()
+
+    def route(self, method, path, body):
+        if path == "/v2/bot/message/reply":
+            with self.cond:
+                self.seen[json.loads(body)["replyToken"]] = time.perf_counter()
+                self.cond.notify_all()
+        return json_reply({"sentMessages": [{"id": "1", "quoteToken": "q"}]})
+
+    def wait(self, token, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: token in self.seen, timeout)
+            return self.seen.get(token)
+
+def webhook(kind, token):
+    events = []
+    if kind == "text":
+        events = [{"type": "message", "mode": "active", "timestamp": int(time.time() * 1000), "webhookEventId": token,
+                   "deliveryContext": {"isRedelivery": False}, "replyToken": token, "source": {"type": "user", "userId": "Ucold"},
+                   "message": {"type": "text", "id": token, "quoteToken": "q", "text": "擲骰子"}}]
+    return json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode()
+
+def post(url, body, timeout=60):
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json", "X-Line-Signature": sign(body)})
+    with urllib.request.urlopen(req, timeout=timeout) as resp: return resp.status
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_once(mode, args, line_url, replies, run):
+    tmp = tempfile.mkdtemp(prefix="cold_")
+    port = free_port()
+    env = {**os.environ, **MODES[mode], "LINE_CHANNEL_SECRET": CHANNEL_SECRET, "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+           "GOOGLE_API_KEY": "bench", "CALLBACK_MODE": args.callback, "LOG_LEVEL": "WARNING",
+           "DECK_DB_PATH": os.path.join(tmp, "decks.db"), "IMAGE_HASH_DB_PATH": os.path.join(tmp, "hashes.db"),
+           "CARD_DB_PATH": os.path.join(tmp, "cards.db"), "BANLIST_DIR": os.path.join(tmp, "banlists")}
+    url = f"http://127.0.0.1:{port}/callback"
+    spawned = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", "--port", str(port), "--line-url", line_url],
+                            env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        token = f"cold-{mode}-{run}"
+        while True:
+            sent = time.perf_counter()
+            try: status = post(url, webhook(args.event, token))
+            except urllib.error.URLError as e:
+                if not isinstance(e.reason, ConnectionRefusedError): raise
+                if proc.poll() is not None: raise RuntimeError(f"app 啟動失敗 (exit {proc.returncode})")
+                if sent - spawned > args.timeout: raise RuntimeError("等不到 app 開始服務")
+                time.sleep(0.005)
+                continue
+            break
+        ok = time.perf_counter()
+        boot = json.loads(proc.stdout.readline())
+        replied = replies.wait(token, args.timeout) if args.event == "text" else ok
+        warm_token = f"{token}-warm"
+        warm_sent = time.perf_counter()
+        post(url, webhook(args.event, warm_token))
+        warm_done = replies.wait(warm_token, args.timeout) if args.event == "text" else time.perf_counter()
+        return {"status": status, "import_ms": boot["import_ms"], "boot": boot["boot"], "first_ok_ms": (ok - spawned) * 1000,
+                "first_request_ms": (ok - sent) * 1000, "first_reply_ms": ((replied or float("nan")) - spawned) * 1000,
+                "warm_ms": ((warm_done or float("nan")) - warm_sent) * 1000}
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--modes", default="eager,lazy,warm")
+    ap.add_argument("--callback", choices=["sync", "async"], default="sync")
+    ap.add_argument("--event", choices=["text", "verify"], default="text")
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    ap.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    ap.add_argument("--line-url", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.serve: return serve(args)
+
+    replies = Replies()
+    line_server, line_url = start_stub(replies.route)
+    line_server.handle_error = lambda request, address: None  # 子 process 結束時 keep-alive 連線被切斷，不必印出來
+    print(f"callback={args.callback} event={args.event} runs={args.runs} (中位數，單位 ms)")
+    print(f"{'mode':<8}{'import':>9}{'首次OK':>10}{'首次請求':>10}{'首次回覆':>10}{'熱請求':>9}")
+    for mode in args.modes.split(","):
+        results = [run_once(mode, args, line_url, replies, run) for run in range(args.runs)]
+        med = lambda key: statistics.median(r[key] for r in results)
+        print(f"{mode:<8}{med('import_ms'):>9.0f}{med('first_ok_ms'):>12.0f}{med('first_request_ms'):>12.0f}"
+              f"{med('first_reply_ms'):>12.0f}{med('warm_ms'):>10.1f}")
+        boot = results[-1]["boot"]
+        loads = " ".join(f"{k}={v:.0f}" for k, v in sorted(boot["load_ms"].items(), key=lambda kv: -kv[1]) if v >= 1)
+        print(f"        開機耗時：{loads}" + (f"；延後載入 {len(boot['pending'])} 項" if boot["pending"] else ""))
+    line_server.shutdown()
+
+if __name__ == "__main__":
+    main()
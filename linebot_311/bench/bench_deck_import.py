@@ -0,0 +1,62 @@
+# ==========================================
+# 貼上大量卡表的效能比較
+#   舊做法：每張卡都重新 sum() 整個區塊與三區合計 (O(n²))
+#   新做法：Deck 累計張數 + import_deck 逐行一次跑完
+#   python bench/bench_deck_import.py --sizes 60 1000 10000 --repeat 5
+# 為了看出差距，這裡把張數上限拿掉 (正式規則仍是 60/15/15)
+# ==========================================
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from deck_import import import_deck, try_add
+from deck_store import Deck
+
+NO_LIMITS = {"main": float("inf"), "extra": float("inf"), "side": float("inf")}
+
+def make_lines(n):
+    return ["主牌組"] + [f"{i % 3 + 1} 測試卡{i:05d}" for i in range(n)]
+
+def old_add(items):
+    deck_data, limits = {"main": {}, "extra": {}, "side": {}}, NO_LIMITS
+    for c_name, c_cnt in items.items():
+        current_type_total = sum(deck_data["main"].values())
+        current_card_total = sum(deck_data[d].get(c_name, 0) for d in ["main", "extra", "side"])
+        if current_type_total + c_cnt > limits["main"] or current_card_total + c_cnt > 3: continue
+        deck_data["main"][c_name] = deck_data["main"].get(c_name, 0) + c_cnt
+    return deck_data
+
+def new_add(items):
+    deck = Deck()
+    for c_name, c_cnt in items.items(): try_add(deck, "main", c_name, c_cnt, limits=NO_LIMITS)
+    return deck
+
+def best_of(repeat, fn, *args):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - t0) * 1000)
+    return min(times)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[60, 1000, 5000, 20000])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    print(f"{'行數':>8}{'舊 sum() ms':>14}{'Deck 累計 ms':>15}{'import_deck ms':>17}")
+    for n in args.sizes:
+        lines = make_lines(n)
+        items = {f"測試卡{i:05d}": i % 3 + 1 for i in range(n)}
+        old_ms = best_of(args.repeat, old_add, items)
+        new_ms = best_of(args.repeat, new_add, items)
+        imp_ms = best_of(args.repeat, lambda: import_deck(lines, limits=NO_LIMITS))
+        deck, _, errors = import_deck(lines, limits=NO_LIMITS)
+        assert deck.section_total["main"] == sum(items.values()) and not errors
+        print(f"{n:>8}{old_ms:>14.2f}{new_ms:>15.2f}{imp_ms:>17.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# ==========================================
+# 圖片前處理效益測試：比較「原圖直接上傳」與「前處理後上傳」
+#   python bench/bench_image_prep.py 照片資料夾/ [--crop] [--format WEBP] [--gemini]
+# 預設只量上傳大小與前處理時間；加 --gemini 會真的呼叫 Gemini 量端到端延遲 (需要 GEMINI_API_KEY)
+# ==========================================
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from image_prep import prepare_image
+
+PROMPT = "請提供：1.【名稱】2.【效果】。"
+EXTS = (".jpg", ".jpeg", ".png", ".webp", ".heic")
+
+def ask(client, model, data, mime_type):
+    from google.genai import types
+    t0 = time.perf_counter()
+    client.models.generate_content(model=model, contents=[PROMPT, types.Part.from_bytes(data=data, mime_type=mime_type)])
+    return (time.perf_counter() - t0) * 1000
+
+def mime_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    return {".png": "image/png", ".webp": "image/webp", ".heic": "image/heic"}.get(ext, "image/jpeg")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("folder")
+    ap.add_argument("--max-edge", type=int, default=1280)
+    ap.add_argument("--max-bytes", type=int, default=350_000)
+    ap.add_argument("--format", default="JPEG")
+    ap.add_argument("--crop", action="store_true")
+    ap.add_argument("--gemini", action="store_true")
+    ap.add_argument("--model", default="gemini-2.5-flash")
+    args = ap.parse_args()
+
+    files = sorted(os.path.join(args.folder, f) for f in os.listdir(args.folder) if f.lower().endswith(EXTS))
+    if not files: sys.exit(f"{args.folder} 裡沒有圖片")
+    client = None
+    if args.gemini:
+        from google import genai
+        client = genai.Client()
+
+    raw_bytes, prep_bytes, prep_ms, raw_e2e, prep_e2e = [], [], [], [], []
+    print(f"{'檔案':<28}{'原圖KB':>10}{'處理後KB':>10}{'處理ms':>9}" + (f"{'原圖e2e ms':>12}{'處理後e2e ms':>14}" if client else ""))
+    for path in files:
+        with open(path, "rb") as f: data = f.read()
+        t0 = time.perf_counter()
+        img, out, mime_type, card = prepare_image(data, args.max_edge, args.crop, args.format, args.max_bytes)
+        ms = (time.perf_counter() - t0) * 1000
+        raw_bytes.append(len(data)); prep_bytes.append(len(out)); prep_ms.append(ms)
+        line = f"{os.path.basename(path)[:27]:<28}{len(data) / 1024:>10.0f}{len(out) / 1024:>10.0f}{ms:>9.1f}"
+        if client:
+            raw_e2e.append(ask(client, args.model, data, mime_of(path)))
+            prep_e2e.append(ask(client, args.model, out, mime_type) + ms)
+            line += f"{raw_e2e[-1]:>12.0f}{prep_e2e[-1]:>14.0f}"
+        print(line)
+
+    print("-" * 60)
+    print(f"圖片數: {len(files)}")
+    print(f"上傳量: {sum(raw_bytes) / 1024:.0f}KB -> {sum(prep_bytes) / 1024:.0f}KB "
+          f"({100 * (1 - sum(prep_bytes) / sum(raw_bytes)):.1f}% 減少)")
+    print(f"前處理時間: 中位數 {statistics.median(prep_ms):.1f}ms / 最大 {max(prep_ms):.1f}ms")
+    if client:
+        print(f"端到端延遲 (中位數): {statistics.median(raw_e2e):.0f}ms -> {statistics.median(prep_e2e):.0f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# ==========================================
+# 每個事件重新建 ApiClient vs 整個 process 共用 LineClients
+# 本機起一個假的 Messaging API (HTTP/1.1 keep-alive)，量每個事件的回覆延遲與實際建立的連線數
+#   python bench/bench_line_clients.py --events 500 --threads 4 --latency 5
+#   python bench/bench_line_clients.py --certfile cert.pem --keyfile key.pem   (加上 TLS，差距更明顯)
+# 自簽憑證：openssl req -x509 -newkey rsa:2048 -nodes -keyout key.pem -out cert.pem -days 1 -subj /CN=localhost
+# ==========================================
+import os
+import sys
+import ssl
+import time
+import json
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage
+from line_clients import LineClients
+
+connections = 0
+connections_lock = threading.Lock()
+
+class StubLineAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # 否則 keep-alive 時標頭與內容分兩次送，會被 delayed ACK 卡 40ms
+    latency = 0.0
+
+    def setup(self):
+        global connections
+        with connections_lock: connections += 1
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"sentMessages": [{"id": "1", "quoteToken": "q"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def start_server(latency, certfile, keyfile):
+    StubLineAPI.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLineAPI)
+    scheme = "http"
+    if certfile:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(certfile, keyfile)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+def make_config(host):
+    configuration = Configuration(access_token="bench", host=host)
+    configuration.verify_ssl = False
+    return configuration
+
+def reply_request(i):
+    return ReplyMessageRequest(reply_token=f"rt{i}", messages=[TextMessage(text="OK")])
+
+def run(label, events, threads, reply_fn):
+    global connections
+    connections = 0
+    latencies = []
+
+    def one(i):
+        t0 = time.perf_counter()
+        reply_fn(i)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool: list(pool.map(one, range(events)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:<16}{events / elapsed:>10.0f}{statistics.median(latencies):>10.2f}{p95:>10.2f}{connections:>8}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=500)
+    ap.add_argument("--threads", type=int, default=4)
+    ap.add_argument("--latency", type=float, default=2.0, help="假 API 每個請求的處理時間 (ms)")
+    ap.add_argument("--certfile")
+    ap.add_argument("--keyfile")
+    args = ap.parse_args()
+
+    server, host = start_server(args.latency / 1000, args.certfile, args.keyfile)
+    if args.certfile:
+        import urllib3
+        urllib3.disable_warnings()
+
+    # 舊做法：每個事件 with ApiClient(...)，連線隨 client 一起關掉
+    def per_event(i):
+        with ApiClient(make_config(host)) as api_client:
+            MessagingApi(api_client).reply_message_with_http_info(reply_request(i))
+
+    line = LineClients(make_config(host), pool_size=args.threads)
+    def pooled(i):
+        line.api.reply_message_with_http_info(reply_request(i))
+
+    print(f"{host}  events={args.events} threads={args.threads} latency={args.latency}ms")
+    print(f"{'':<16}{'事件/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'連線數':>8}")
+    run("每次新 client", args.events, args.threads, per_event)
+    run("共用 LineClients", args.events, args.threads, pooled)
+    print("pool:", line.pool_stats())
+    line.close()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
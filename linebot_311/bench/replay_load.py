@@ -0,0 +1,372 @@
+# ==========================================
+# /callback 重播壓測
+# 本機起三個假服務 (Messaging API / 下載圖片的 blob API / Gemini)，延遲照指定的分佈抽樣，
+# 把 replay_scripts.json 裡的對話 (決鬥計算、牌組編輯、擲骰子、問答、照片辨識) 產生成有正確簽章的 webhook，
+# 以固定速率打進真的 Flask app，從「送出 webhook」量到「假 Messaging API 收到回覆」(來不及回覆改 push 的算到 push 為止)
+#   python bench/replay_load.py --rate 50 --duration 30 --users 100
+#   python bench/replay_load.py --mode async --workers 8 --json out.json --compare before.json
+# 每一拍輪到一位閒置的虛擬使用者送出他腳本的下一步 (同一人一定等上一步回覆後才送下一步)，所以每人約每 users/rate 秒動一次
+# 延遲分佈：const:20 / uniform:10:50 / lognormal:中位數:sigma (單位 ms)，固定 --seed 讓不同 commit 的結果可以比較
+# ==========================================
+import os
+import sys
+import io
+import re
+import json
+import zlib
+import hmac
+import math
+import time
+import queue
+import base64
+import random
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+CHANNEL_SECRET = "bench-secret"
+
+SAMPLE_CARDS = [
+    {"id": 14558127, "name_zh": "灰流麗", "name_ja": "灰流うらら", "name_en": "Ash Blossom & Joyous Spring", "type": "效果怪獸", "desc": "這張卡從手牌丟棄才能發動。那個效果無效。", "section": "main"},
+    {"id": 23434538, "name_zh": "增殖的G", "name_ja": "増殖するＧ", "name_en": "Maxx \"C\"", "type": "效果怪獸", "desc": "這張卡從手牌送去墓地才能發動。對方每次特殊召喚，自己抽1張。", "section": "main"},
+    {"id": 89631139, "name_zh": "青眼白龍", "name_ja": "青眼の白龍", "name_en": "Blue-Eyes White Dragon", "type": "通常怪獸", "desc": "以高攻擊力著稱的傳說之龍。", "section": "main"},
+    {"id": 84211599, "name_zh": None, "name_ja": "強欲で金満な壺", "name_en": "Pot of Extravagance", "type": "魔法", "desc": "從額外牌組除外3張或6張才能發動。抽1張或2張。", "section": "main"},
+    {"id": 23995346, "name_zh": "青眼究極龍", "name_ja": "青眼の究極竜", "name_en": "Blue-Eyes Ultimate Dragon", "type": "融合怪獸", "desc": "「青眼白龍」＋「青眼白龍」＋「青眼白龍」", "section": "extra"},
+]
+
+# --- 延遲分佈 ---
+def parse_dist(spec):
+    kind, *nums = spec.split(":")
+    nums = [float(n) for n in nums]
+    if kind == "const": return lambda rng: nums[0] / 1000
+    if kind == "uniform": return lambda rng: rng.uniform(nums[0], nums[1]) / 1000
+    if kind == "lognormal": return lambda rng: rng.lognormvariate(math.log(nums[0]), nums[1]) / 1000
+    raise ValueError(f"不認得的延遲分佈：{spec}")
+
+class Latency:
+    def __init__(self, spec, seed):
+        self.sample = parse_dist(spec)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sleep(self):
+        with self.lock: delay = self.sample(self.rng)
+        time.sleep(delay)
+
+# --- 假服務 ---
+def start_stub(route):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _serve(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, ctype, payload = route(self.command, self.path, body)
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = _serve
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def json_reply(obj, status=200):
+    return status, "application/json", json.dumps(obj).encode()
+
+def messaging_route(latency, recorder):
+    sent = {"sentMessages": [{"id": "1", "quoteToken": "q"}]}
+    def route(method, path, body):
+        latency.sleep()
+        if path == "/v2/bot/message/reply":
+            req = json.loads(body)
+            recorder.on_reply(req["replyToken"], [m.get("text", "") for m in req["messages"]])
+            return json_reply(sent)
+        if path == "/v2/bot/message/push":
+            req = json.loads(body)
+            recorder.on_push(req["to"], [m.get("text", "") for m in req["messages"]])
+            return json_reply(sent)
+        if path == "/v2/bot/chat/loading/start": return json_reply({}, 202)
+        return json_reply({"message": "not found"}, 404)
+    return route
+
+def make_images(count, seed):
+    from PIL import Image, ImageDraw
+    rng, images = random.Random(seed), []
+    for _ in range(count):
+        img = Image.new("RGB", (1600, 1200), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((500, 150, 1100, 1050), fill=tuple(rng.randrange(256) for _ in range(3)), outline=(20, 20, 20), width=12)
+        for _ in range(40):
+            x, y = rng.randrange(520, 1080), rng.randrange(170, 1030)
+            draw.ellipse((x, y, x + rng.randrange(10, 120), y + rng.randrange(10, 120)), fill=tuple(rng.randrange(256) for _ in range(3)))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+def blob_route(latency, images):
+    def route(method, path, body):
+        latency.sleep()
+        match = re.match(r"^/v2/bot/message/([^/]+)/content$", path)
+        if not match: return json_reply({"message": "not found"}, 404)
+        return 200, "image/jpeg", images[zlib.crc32(match.group(1).encode()) % len(images)]
+    return route
+
+def gemini_route(latency, search_latency):
+    search_caches, lock, counter = set(), threading.Lock(), [0]
+    def route(method, path, body):
+        req = json.loads(body or b"{}")
+        if path.endswith("/cachedContents"):
+            with lock:
+                counter[0] += 1
+                name = f"cachedContents/bench{counter[0]}"
+                if req.get("tools"): search_caches.add(name)
+            return json_reply({"name": name, "model": req.get("model"), "expireTime": "2099-01-01T00:00:00Z"})
+        if not path.endswith(":generateContent"): return json_reply({"error": {"code": 404, "message": "not found"}}, 404)
+        parts = [p for c in req.get("contents", []) for p in c.get("parts", [])]
+        text = "".join(p.get("text", "") for p in parts)
+        images = sum(1 for p in parts if "inlineData" in p)
+        grounded = any("googleSearch" in t for t in req.get("tools", []) or []) or req.get("cachedContent") in search_caches
+        latency.sleep()
+        if grounded: search_latency.sleep()
+        if "只寫卡片名稱" in text: answer = "\n".join(["灰流麗"] * images)
+        else: answer = "\n=====\n".join(f"(bench) 第 {i + 1} 段回答" for i in range(max(images, text.count("【第 "), 1)))
+        prompt_tokens = len(text) + images * 1300
+        return json_reply({"candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}, "finishReason": "STOP"}],
+                           "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(answer),
+                                             "totalTokenCount": prompt_tokens + len(answer)}})
+    return route
+
+# --- 紀錄每一步的回覆 ---
+class Pending:
+    __slots__ = ("user", "cmd", "sent", "finished", "late", "done")
+
+    def __init__(self, user, cmd):
+        self.user, self.cmd, self.sent, self.finished, self.late = user, cmd, 0.0, None, False
+        self.done = threading.Event()
+
+class Recorder:
+    def __init__(self):
+        self.by_token, self.by_user = {}, {}
+        self.lock = threading.Lock()
+        self.unexpected = 0
+
+    def expect(self, token, pending):
+        with self.lock: self.by_token[token] = pending
+
+    def forget(self, token):
+        with self.lock: self.by_token.pop(token, None)
+
+    def on_reply(self, token, texts):
+        now = time.perf_counter()
+        with self.lock:
+            pending = self.by_token.pop(token, None)
+            if pending is None:
+                self.unexpected += 1
+                return
+            # 先回「稍後送達」的，等 push 到了才算完成
+            if any(t.startswith("⏳") for t in texts):
+                pending.late = True
+                self.by_user[pending.user] = pending
+                return
+        pending.finished = now
+        pending.done.set()
+
+    def on_push(self, user, texts):
+        now = time.perf_counter()
+        with self.lock: pending = self.by_user.pop(user, None)
+        if pending is None: return
+        pending.finished = now
+        pending.done.set()
+
+# --- 虛擬使用者 ---
+def sign(body):
+    return base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+
+class VirtualUser:
+    def __init__(self, uid, script):
+        self.uid, self.script, self.cursor, self.iteration, self.seq = uid, script, 0, 0, 0
+
+    def next_step(self):
+        step = self.script["steps"][self.cursor]
+        self.cursor += 1
+        if self.cursor == len(self.script["steps"]): self.cursor, self.iteration = 0, self.iteration + 1
+        return step
+
+    def build(self, step):
+        self.seq += 1
+        base = {"mode": "active", "timestamp": int(time.time() * 1000), "deliveryContext": {"isRedelivery": False},
+                "source": {"type": "user", "userId": self.uid}}
+        tag = f"{self.uid}-{self.seq}"
+        if "text" in step:
+            text = step["text"].format(iter=self.iteration, user=self.uid)
+            events = [{**base, "type": "message", "webhookEventId": tag, "replyToken": f"rt-{tag}",
+                       "message": {"type": "text", "id": tag, "quoteToken": "q", "text": text}}]
+        else:
+            total = step["images"]
+            events = []
+            for i in range(total):
+                message = {"type": "image", "id": f"{tag}-{i}", "quoteToken": "q", "contentProvider": {"type": "line"}}
+                if total > 1: message["imageSet"] = {"id": tag, "index": i + 1, "total": total}
+                events.append({**base, "type": "message", "webhookEventId": f"{tag}-{i}", "replyToken": f"rt-{tag}-{i}", "message": message})
+        return json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode(), events[0]["replyToken"]
+
+def assign_scripts(scripts, mix, users):
+    weights = [mix.get(s["name"], 0) for s in scripts]
+    pool = [s for s, w in zip(scripts, weights) for _ in range(w)]
+    return [VirtualUser(f"Ubench{n:05d}", pool[n % len(pool)]) for n in range(users)]
+
+# --- 統計 ---
+def percentile(values, p):
+    if not values: return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+def summarize(results, duration):
+    commands, all_ms = {}, []
+    for cmd, rows in sorted(results.items()):
+        ms = sorted(r[0] for r in rows if r[0] is not None)
+        all_ms += ms
+        commands[cmd] = {"count": len(rows), "errors": sum(1 for r in rows if r[0] is None), "late": sum(1 for r in rows if r[1]),
+                         "p50": round(percentile(ms, 50), 1), "p95": round(percentile(ms, 95), 1),
+                         "p99": round(percentile(ms, 99), 1), "max": round(ms[-1], 1) if ms else 0.0}
+    all_ms.sort()
+    total = {"count": sum(c["count"] for c in commands.values()), "errors": sum(c["errors"] for c in commands.values()),
+             "late": sum(c["late"] for c in commands.values()), "throughput": round(len(all_ms) / duration, 2),
+             "p50": round(percentile(all_ms, 50), 1), "p95": round(percentile(all_ms, 95), 1), "p99": round(percentile(all_ms, 99), 1), "max": round(all_ms[-1], 1) if all_ms else 0.0}
+    return commands, total
+
+def print_table(commands, total, previous=None):
+    print(f"{'指令':<14}{'次數':>7}{'錯誤':>6}{'push':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for cmd, c in list(commands.items()) + [("(全部)", total)]:
+        line = f"{cmd:<14}{c['count']:>7}{c['errors']:>6}{c['late']:>6}{c['p50']:>10.1f}{c['p95']:>10.1f}{c['p99']:>10.1f}{c.get('max', 0):>10.1f}"
+        old = (previous or {}).get("commands", {}).get(cmd) if cmd != "(全部)" else (previous or {}).get("total")
+        if old and old["p95"]: line += f"   p95 {((c['p95'] - old['p95']) / old['p95']):+.0%} vs {previous['commit']}"
+        print(line)
+    print(f"吞吐量：{total['throughput']} 步/秒" + (f" (之前 {previous['total']['throughput']})" if previous else ""))
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip() or "unknown"
+    except OSError: return "unknown"
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rate", type=float, default=30, help="每秒送出幾個 webhook")
+    ap.add_argument("--duration", type=float, default=20)
+    ap.add_argument("--warmup", type=float, default=3, help="前幾秒不列入統計")
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--scripts", default=os.path.join(HERE, "replay_scripts.json"))
+    ap.add_argument("--mix", default="duel=3,deck=2,random=2,ask=1,image=1", help="各腳本的使用者比例 (沒列到的腳本不跑)")
+    ap.add_argument("--mode", choices=["sync", "async"], default="sync")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--line-latency", default="lognormal:40:0.3")
+    ap.add_argument("--blob-latency", default="lognormal:80:0.4")
+    ap.add_argument("--gemini-latency", default="lognormal:1500:0.4")
+    ap.add_argument("--search-latency", default="lognormal:2500:0.5", help="開 google_search 時額外增加的延遲")
+    ap.add_argument("--image-variants", type=int, default=20, help="假照片有幾種 (重複的會吃到雜湊快取)")
+    ap.add_argument("--step-timeout", type=float, default=90)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="把結果寫成 JSON")
+    ap.add_argument("--compare", help="和之前 --json 的結果比較")
+    args = ap.parse_args()
+
+    recorder = Recorder()
+    line_server, line_url = start_stub(messaging_route(Latency(args.line_latency, args.seed), recorder))
+    blob_server, blob_url = start_stub(blob_route(Latency(args.blob_latency, args.seed + 1), make_images(args.image_variants, args.seed)))
+    gemini_server, gemini_url = start_stub(gemini_route(Latency(args.gemini_latency, args.seed + 2), Latency(args.search_latency, args.seed + 3)))
+
+    tmp = tempfile.mkdtemp(prefix="replay_")
+    with open(os.path.join(tmp, "cards.json"), "w", encoding="utf-8") as f: json.dump(SAMPLE_CARDS, f, ensure_ascii=False)
+    os.environ.update(LINE_CHANNEL_SECRET=CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN="bench", GOOGLE_API_KEY="bench",
+                      GOOGLE_GEMINI_BASE_URL=gemini_url, CALLBACK_MODE=args.mode, WORKER_COUNT=str(args.workers),
+                      DECK_DB_PATH=os.path.join(tmp, "decks.db"), IMAGE_HASH_DB_PATH=os.path.join(tmp, "hashes.db"),
+                      CARD_DB_PATH=os.path.join(tmp, "cards.db"), CARD_DB_DUMP=os.path.join(tmp, "cards.json"),
+                      BANLIST_DIR=os.path.join(tmp, "banlists"), LOG_LEVEL="WARNING")
+    random.seed(args.seed)
+    import app
+    from linebot.v3.messaging import Configuration
+    from line_clients import LineClients
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # LINE API 指到假服務：SDK 每個請求都以 _host 傳入寫死的網址，api-data.line.me (下載圖片) 轉到假的 blob 服務，其他轉到 line_url
+    # Configuration 不能設 host：設了之後 SDK 會忽略 _host，下載圖片也會打到 Messaging API 的假服務
+    app.line = LineClients(Configuration(access_token="bench"), pool_size=max(10, args.workers * 2))
+    call_api = app.line.client.call_api
+    app.line.client.call_api = lambda *a, _host=None, **kw: call_api(*a, _host=blob_url if "api-data" in (_host or "") else line_url, **kw)
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    callback_url = f"http://127.0.0.1:{server.server_port}/callback"
+
+    with open(args.scripts, encoding="utf-8") as f: scripts = json.load(f)
+    mix = {k: int(v) for k, v in (item.split("=") for item in args.mix.split(",") if item)}
+    idle = queue.Queue()
+    for user in assign_scripts(scripts, mix, args.users): idle.put(user)
+
+    results, results_lock = {}, threading.Lock()
+    measure_from = time.perf_counter() + args.warmup
+
+    def run_step(user):
+        step = user.next_step()
+        body, token = user.build(step)
+        pending = Pending(user.uid, step["cmd"])
+        recorder.expect(token, pending)
+        req = urllib.request.Request(callback_url, data=body, headers={"Content-Type": "application/json", "X-Line-Signature": sign(body)})
+        pending.sent = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=args.step_timeout) as resp: ok = resp.status == 200
+        except Exception:
+            ok = False
+        ok = ok and pending.done.wait(max(0.0, pending.sent + args.step_timeout - time.perf_counter()))
+        if not ok: recorder.forget(token)
+        if pending.sent >= measure_from:
+            row = ((pending.finished - pending.sent) * 1000 if ok else None, pending.late)
+            with results_lock: results.setdefault(step["cmd"], []).append(row)
+        idle.put(user)
+
+    print(f"{args.mode} mode, {args.rate}/s x {args.duration}s (+{args.warmup}s warmup), {args.users} users, commit {git_commit()}")
+    skipped = 0
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        next_at, end = time.perf_counter(), measure_from + args.duration
+        while next_at < end:
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+            next_at += 1 / args.rate
+            try: user = idle.get_nowait()
+            except queue.Empty:
+                skipped += next_at >= measure_from  # 所有虛擬使用者都在等回覆，這一拍送不出去
+                continue
+            pool.submit(run_step, user)
+
+    commands, total = summarize(results, args.duration)
+    total["skipped_ticks"] = skipped
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f: previous = json.load(f)
+    print_table(commands, total, previous)
+    if skipped: print(f"⚠️ 有 {skipped} 拍因為使用者都在等回覆而沒送出，實際速率低於目標，可加大 --users")
+    if recorder.unexpected: print(f"⚠️ 收到 {recorder.unexpected} 個對不上的回覆")
+    print("gemini:", json.dumps(app.judge.snapshot_stats(), ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"commit": git_commit(), "args": vars(args), "commands": commands, "total": total}, f, ensure_ascii=False, indent=2)
+
+    server.shutdown()
+    for s in (line_server, blob_server, gemini_server): s.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# ==========================================
+# 壓力測試：多位使用者同時交錯送出「扣血」與「編輯牌組」事件，
+# 確認依使用者分流 (lane) 後，每個人的最終狀態都正確
+#   python bench/stress_lanes.py --users 50 --rounds 20 --workers 8
+#   python bench/stress_lanes.py --no-lanes   (對照組：事件隨機分配給 worker)
+# ==========================================
+import os
+import sys
+import json
+import time
+import random
+import hmac
+import logging
+import base64
+import hashlib
+import argparse
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'stress-secret')
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'stress-token')
+os.environ.setdefault('GOOGLE_API_KEY', 'stress-key')
+os.environ['CALLBACK_MODE'] = 'sync'
+os.environ['DECK_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'stress.db')
+
+import app
+from dispatcher import EventDispatcher
+
+# 失敗次數會記在 stats['failed']，不必把每個 traceback 都印出來
+logging.getLogger('dispatcher').setLevel(logging.CRITICAL)
+
+# --- 假的 LINE / Gemini：不連網，只加一點隨機延遲讓執行緒交錯 ---
+fallback_hits = itertools.count()
+
+class StubMessagingApi:
+    def reply_message_with_http_info(self, req): time.sleep(random.random() / 1000)
+
+class StubLineClients:
+    api = StubMessagingApi()
+    def show_loading(self, chat_id, seconds): time.sleep(random.random() / 1000)
+
+class StubModels:
+    def generate_content(self, **kw):
+        next(fallback_hits)
+        return type("Resp", (), {"text": "stub", "usage_metadata": None})()
+
+app.line = StubLineClients()
+app.client = app.judge.client = type("StubClient", (), {"models": StubModels()})()
+app.judge.use_cache = False
+
+def text_event(user_id, text, seq):
+    return {"type": "message", "mode": "active", "timestamp": seq, "webhookEventId": f"ev{seq}",
+            "deliveryContext": {"isRedelivery": False}, "replyToken": f"rt{seq}",
+            "source": {"type": "user", "userId": user_id},
+            "message": {"type": "text", "id": str(seq), "quoteToken": "q", "text": text}}
+
+def user_script(rounds):
+    msgs = ["決鬥開始", "選擇調整我方", "流程_建立牌組", "D"]
+    for i in range(rounds):
+        msgs += ["-100", "準備新增主牌 D", f"C{i}*1"]
+    return msgs
+
+def sign(body):
+    digest = hmac.new(os.environ['LINE_CHANNEL_SECRET'].encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--no-lanes", action="store_true")
+    args = ap.parse_args()
+
+    # 交錯排列：每位使用者自己的順序不變，不同使用者之間隨機穿插
+    pending = {f"U{u:04d}": user_script(args.rounds) for u in range(args.users)}
+    raw, seq = [], 0
+    while pending:
+        uid = random.choice(list(pending))
+        raw.append(text_event(uid, pending[uid].pop(0), seq)); seq += 1
+        if not pending[uid]: del pending[uid]
+    body = json.dumps({"destination": "x", "events": raw})
+    assert app.verify_signature(body, sign(body))
+    events = json.loads(body)["events"]
+
+    key_fn = (lambda e: random.random()) if args.no_lanes else app.event_user_id
+    d = EventDispatcher(app.handle_event, workers=args.workers, maxsize=len(events) + args.workers,
+                        key_fn=key_fn).start()
+    t0 = time.perf_counter()
+    for e in events: d.submit(e)
+    d.shutdown(timeout=600)
+    elapsed = time.perf_counter() - t0
+
+    expected_lp = 8000 - 100 * args.rounds
+    expected_main = {f"C{i}": 1 for i in range(args.rounds)}
+    bad = 0
+    for u in range(args.users):
+        uid = f"U{u:04d}"
+        duel = app.user_duels.get(uid, {})
+        deck = app.deck_store.decks(uid).get("D", {}).get("main")
+        if duel.get("我方") != expected_lp or deck != expected_main: bad += 1
+
+    print(f"events={len(events)} workers={args.workers} lanes={'off' if args.no_lanes else 'on'} "
+          f"elapsed={elapsed:.2f}s rate={len(events) / elapsed:.0f}/s")
+    print(f"users_ok={args.users - bad}/{args.users} gemini_fallbacks={next(fallback_hits)} stats={d.stats()}")
+    sys.exit(1 if bad else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import sys
+import json
+import sqlite3
+import difflib
+import threading
+
+from gemini_cache import normalize_query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    id       INTEGER PRIMARY KEY,
+    name_zh  TEXT,
+    name_ja  TEXT,
+    name_en  TEXT,
+    type     TEXT,
+    desc     TEXT,
+    section  TEXT NOT NULL DEFAULT 'main'
+);
+CREATE TABLE IF NOT EXISTS card_names (
+    norm     TEXT NOT NULL,
+    card_id  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS card_names_norm ON card_names (norm);
+CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5(names, tokenize='trigram');
+"""
+
+# YGOPRODeck 的 frameType 中屬於額外牌組的種類
+EXTRA_FRAMES = {"fusion", "synchro", "xyz", "link", "fusion_pendulum", "synchro_pendulum", "xyz_pendulum"}
+
+def card_name(card):
+    return card["name_zh"] or card["name_ja"] or card["name_en"]
+
+# ==========================================
+# 本地卡片資料庫 (SQLite + FTS5 trigram 索引)
+# 資料來源 (CARD_DB_DUMP) 支援兩種 JSON：
+#   1. [{"id": 14558127, "name_zh": "灰流麗", "name_ja": "灰流うらら", "name_en": "Ash Blossom & Joyous Spring",
+#        "type": "效果怪獸", "desc": "...", "section": "main"}, ...]
+#   2. YGOPRODeck API 的 {"data": [...]} (只有英文名，依 frameType 判斷主/額外)
+# 查詢流程：正規化後完全相同 -> 直接命中；否則用 trigram 找候選，再用相似度排序
+# ==========================================
+class CardDB:
+    def __init__(self, path="cards.db"):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.size = self._db.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+
+    def __bool__(self):
+        return self.size > 0
+
+    # --- 匯入 ---
+    def load_dump(self, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and "data" in data:
+            data = [{"id": c["id"], "name_en": c["name"], "type": c.get("type"), "desc": c.get("desc"),
+                     "section": "extra" if c.get("frameType") in EXTRA_FRAMES else "main"} for c in data["data"]]
+        rows = [(c["id"], c.get("name_zh"), c.get("name_ja"), c.get("name_en"), c.get("type"), c.get("desc"),
+                 c.get("section", "main")) for c in data]
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM cards")
+            self._db.execute("DELETE FROM card_names")
+            self._db.execute("DELETE FROM cards_fts")
+            self._db.executemany("INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            names = [(card_id, [n for n in (zh, ja, en) if n]) for card_id, zh, ja, en, *_ in rows]
+            self._db.executemany("INSERT INTO card_names VALUES (?, ?)",
+                                 [(normalize_query(n), card_id) for card_id, ns in names for n in ns])
+            self._db.executemany("INSERT INTO cards_fts (rowid, names) VALUES (?, ?)",
+                                 [(card_id, " ".join(normalize_query(n) for n in ns)) for card_id, ns in names])
+            self.size = len(rows)
+        return self.size
+
+    # --- 查詢 ---
+    def lookup(self, name):
+        norm = normalize_query(name)
+        with self._lock:
+            row = self._db.execute("SELECT c.* FROM card_names n JOIN cards c ON c.id = n.card_id WHERE n.norm = ? LIMIT 1", (norm,)).fetchone()
+        return dict(row) if row else None
+
+    def get(self, card_id):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM cards WHERE id = ?", (card_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _candidates(self, norm):
+        with self._lock:
+            if len(norm) < 3:
+                rows = self._db.execute("SELECT c.* FROM card_names n JOIN cards c ON c.id = n.card_id WHERE n.norm LIKE ? LIMIT 50",
+                                        (f"%{norm}%",)).fetchall()
+            else:
+                grams = {norm[i:i + 3] for i in range(len(norm) - 2)}
+                match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+                rows = self._db.execute("SELECT c.* FROM cards_fts f JOIN cards c ON c.id = f.rowid WHERE cards_fts MATCH ? ORDER BY bm25(cards_fts) LIMIT 50",
+                                        (match,)).fetchall()
+        return list({row["id"]: dict(row) for row in rows}.values())
+
+    def search(self, query, limit=5):
+        norm = normalize_query(query)
+        if not norm: return []
+        scored = []
+        for card in self._candidates(norm):
+            score = max(difflib.SequenceMatcher(None, norm, normalize_query(n)).ratio()
+                        for n in (card["name_zh"], card["name_ja"], card["name_en"]) if n)
+            scored.append((score, card))
+        scored.sort(key=lambda x: -x[0])
+        return [(card, round(score, 3)) for score, card in scored[:limit]]
+
+    # 一整句問題裡提到哪些卡：卡名 (允許少數錯字) 出現在句子中才算，長的卡名優先
+    def mentions(self, text, limit=3, min_cover=0.8):
+        norm = normalize_query(text)
+        if len(norm) < 3:
+            card = self.lookup(text)
+            return [card] if card else []
+        found = []
+        for card in self._candidates(norm):
+            best = 0
+            for n in (card["name_zh"], card["name_ja"], card["name_en"]):
+                name = normalize_query(n or "")
+                if len(name) < 2: continue
+                if name in norm: size = len(name)
+                else: size = difflib.SequenceMatcher(None, name, norm, autojunk=False).find_longest_match(0, len(name), 0, len(norm)).size
+                if size >= 3 and size >= min_cover * len(name): best = max(best, size)
+            if best: found.append((best, card))
+        found.sort(key=lambda x: -x[0])
+        return [card for _, card in found[:limit]]
+
+    # 整段文字就是某一張卡的名稱 (查卡用)：完全相同，或只提到一張卡且整段和卡名幾乎一樣
+    # 「灰流麗對增殖的G」「青眼白龍融合」這類只是含有卡名的問題回傳 None，交給 Gemini
+    def named(self, text, min_score=0.85):
+        card = self.lookup(text)
+        if card: return card
+        if len(self.mentions(text, limit=2)) > 1: return None
+        hits = self.search(text, limit=1)
+        return hits[0][0] if hits and hits[0][1] >= min_score else None
+
+    # 回傳 (卡片, 是否完全相同)；找不到夠像的就回傳 (None, False)
+    def resolve(self, name, min_score=0.6):
+        card = self.lookup(name)
+        if card: return card, True
+        hits = self.search(name, limit=1)
+        if hits and hits[0][1] >= min_score: return hits[0][0], False
+        return None, False
+
+def format_card(card):
+    names = " / ".join(n for n in (card["name_zh"], card["name_ja"], card["name_en"]) if n)
+    section = "額外牌組" if card["section"] == "extra" else "主牌組"
+    return f"🃏 {names}\n🔹 種類：{card['type'] or '-'} ({section})\n➖➖➖➖➖➖\n{card['desc'] or '(無效果文字)'}"
+
+# 用法：python card_db.py load cards_dump.json [cards.db]
+#       python card_db.py search 灰流 [cards.db]
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("load", "search"):
+        sys.exit("用法：python card_db.py load <dump.json> | search <關鍵字> [db 路徑]")
+    db = CardDB(sys.argv[3] if len(sys.argv) > 3 else "cards.db")
+    if sys.argv[1] == "load":
+        print(f"已匯入 {db.load_dump(sys.argv[2])} 張卡片")
+    else:
+        for card, score in db.search(sys.argv[2]): print(f"{score:.2f}  {card_name(card)}")
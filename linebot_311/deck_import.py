@@ -0,0 +1,105 @@
+import re
+
+from deck_store import Deck
+from card_db import card_name
+from banlist import LIMIT_TW
+
+DECK_LIMITS = {"main": 60, "extra": 15, "side": 15}
+SECTION_TW = {"main": "主牌組", "extra": "額外牌組", "side": "備牌"}
+
+# ==========================================
+# 新增一張卡 (單卡新增與整副匯入共用)
+# 有卡片資料庫時會檢查/修正卡名並確認主/額外牌組；上限用 Deck 的累計張數檢查，O(1)
+# 回傳 (實際卡名, 修正提示或 None, 錯誤訊息或 None)；沒有錯誤才會真的加進牌組
+# section 為 None 時依卡片種類自動放主牌組或額外牌組
+# ==========================================
+def try_add(deck, section, name, count, card_db=None, banlist=None, ban_version=None, limits=DECK_LIMITS):
+    note = None
+    if card_db:
+        card, exact = card_db.resolve(name)
+        if card is None:
+            return name, None, f"❌ {name}：找不到這張卡，請確認卡名"
+        if not exact: note = f"🔁 {name} → {card_name(card)}"
+        name = card_name(card)
+        if section is None: section = card["section"]
+        if section != "side" and card["section"] != section:
+            return name, note, f"❌ {name}：這張卡屬於{SECTION_TW[card['section']]}"
+    section = section or "main"
+
+    current_card_total = deck.card_total.get(name, 0)
+    if deck.section_total[section] + count > limits[section]:
+        return name, note, f"❌ {name}：{SECTION_TW[section]}已達上限 ({limits[section]}張)"
+    max_copies = banlist.limit(name, ban_version) if banlist else 3
+    if current_card_total + count > max_copies:
+        if max_copies < 3: return name, note, f"❌ {name}：禁卡表({ban_version})為{LIMIT_TW[max_copies]}卡，最多{max_copies}張 (現有{current_card_total}張)"
+        return name, note, f"❌ {name}：同名卡最多3張 (現有{current_card_total}張)"
+
+    deck.add(section, name, count)
+    return name, note, None
+
+# ==========================================
+# 整副牌組匯入 (.ydk 或貼上的文字卡表)，逐行讀取、一次跑完
+#   .ydk：#main / #extra / !side 底下每行一個卡片密碼 (需要卡片資料庫對應卡名)
+#   文字：「主牌組 / 額外牌組 / 備牌」(或 main / extra / side) 當分段標題，每行一張卡：
+#         3 灰流麗、3x 灰流麗、灰流麗 x3、灰流麗*3、 - 灰流麗 * 3 (查看牌組的輸出格式)
+#         也接受一行多張：『青眼白龍*3 融合*1』
+#   沒有分段標題時依卡片種類自動分主/額外 (沒有資料庫就全部當主牌組)
+# ==========================================
+HEADER = re.compile(r'^[#!🔹\s]*(主牌組|主牌|main(?:\s*deck)?|額外牌組|額外|extra(?:\s*deck)?|備牌組|備牌|side(?:\s*deck)?)'
+                    r'\s*(?:[\(（]\s*\d+\s*張?\s*[\)）])?\s*[:：]?\s*$', re.IGNORECASE)
+SECTION_OF = {"主": "main", "m": "main", "額": "extra", "e": "extra", "備": "side", "s": "side"}
+COUNT_FIRST = re.compile(r'^(\d+)\s*[x×*]?\s+(.+)$', re.IGNORECASE)
+COUNT_LAST = re.compile(r'^(.+?)\s*[x×*]\s*(\d+)$', re.IGNORECASE)
+MULTI_TOKEN = re.compile(r'\S+\*\d+')
+
+def parse_lines(lines, card_db=None):
+    section = None
+    for line_no, raw in enumerate(lines, 1):
+        line = raw.strip().lstrip("-▪️•").strip()
+        if not line or line.startswith("#created") or line in ("(空)", "➖➖➖➖➖➖"): continue
+        if header := HEADER.match(line):
+            section = SECTION_OF[header.group(1)[0].lower()]
+            continue
+        if line.isdigit():
+            card = card_db.get(int(line)) if card_db else None
+            if card is None: yield line_no, section, None, 0, f"❌ 卡片密碼 {line} 不在卡片資料庫中"
+            else: yield line_no, section, card_name(card), 1, None
+            continue
+        if len(MULTI_TOKEN.findall(line)) > 1:
+            entries = [(tok.rsplit("*", 1)[0], int(tok.rsplit("*", 1)[1])) if MULTI_TOKEN.fullmatch(tok) else (tok, 1) for tok in line.split()]
+        elif m := COUNT_FIRST.match(line):
+            entries = [(m.group(2).strip(), int(m.group(1)))]
+        elif m := COUNT_LAST.match(line):
+            entries = [(m.group(1).strip(), int(m.group(2)))]
+        else:
+            entries = [(line, 1)]
+        for name, count in entries:
+            if count <= 0: yield line_no, section, name, count, f"❌ {name}：張數必須大於 0"
+            else: yield line_no, section, name, count, None
+
+def import_deck(lines, card_db=None, banlist=None, limits=DECK_LIMITS):
+    deck, errors, notes = Deck(), [], []
+    ban_version = banlist.current_version if banlist else None
+    for line_no, section, name, count, error in parse_lines(lines, card_db):
+        if error is None:
+            name, note, error = try_add(deck, section, name, count, card_db, banlist, ban_version, limits)
+            if note: notes.append((line_no, note))
+        if error: errors.append((line_no, error))
+    return deck, notes, errors
+
+def format_details(notes, errors, max_lines=30):
+    details = [f"第 {n} 行：{msg}" for n, msg in sorted(notes + errors)]
+    if not details: return ""
+    text = "\n➖➖➖➖➖➖\n" + "\n".join(details[:max_lines])
+    if len(details) > max_lines: text += f"\n…還有 {len(details) - max_lines} 筆"
+    return text
+
+def format_import_result(deck_name, deck, notes, errors, max_lines=30):
+    text = f"📥 【{deck_name}】匯入完成：\n"
+    text += " / ".join(f"{SECTION_TW[s]} {deck.section_total[s]}張" for s in ("main", "extra", "side"))
+    return text + format_details(notes, errors, max_lines)
+
+# 一張都沒加進去 (多半是打錯字或貼錯東西)：不覆蓋原本的牌組
+def format_import_failure(deck_name, errors, max_lines=30):
+    text = f"❌ 沒有任何一張卡匯入成功，牌組【{deck_name}】維持原樣。\n請重新貼上卡表或上傳 .ydk，或點擊「取消」。"
+    return text + format_details([], errors, max_lines)
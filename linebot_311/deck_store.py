@@ -0,0 +1,288 @@
+import sys
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    user_id    TEXT NOT NULL,
+    deck_name  TEXT NOT NULL,
+    data       TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, deck_name)
+);
+CREATE TABLE IF NOT EXISTS duels (
+    user_id    TEXT PRIMARY KEY,
+    data       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+SECTIONS = ("main", "extra", "side")
+
+# ==========================================
+# 牌組：外觀仍是 {"main": {}, "extra": {}, "side": {}}，存檔格式不變
+# 另外維護各區總張數 (section_total) 與每張卡三區合計 (card_total)，
+# 新增/移除時順便更新，檢查上限不必每次重新加總 (貼 60 張卡不再是 O(n²))
+# ==========================================
+class Deck(dict):
+    def __init__(self, data=None):
+        super().__init__({s: dict((data or {}).get(s, {})) for s in SECTIONS})
+        self.section_total = {s: sum(self[s].values()) for s in SECTIONS}
+        self.card_total = {}
+        for s in SECTIONS:
+            for name, count in self[s].items(): self.card_total[name] = self.card_total.get(name, 0) + count
+
+    def add(self, section, name, count):
+        self[section][name] = self[section].get(name, 0) + count
+        self.section_total[section] += count
+        self.card_total[name] = self.card_total.get(name, 0) + count
+
+    # 依 主 -> 額外 -> 備牌 的順序移除，回傳實際移除張數
+    def remove(self, name, count):
+        remaining = count
+        for s in SECTIONS:
+            if remaining <= 0: break
+            if name in self[s]:
+                del_amt = min(self[s][name], remaining)
+                self[s][name] -= del_amt
+                self.section_total[s] -= del_amt
+                remaining -= del_amt
+                if self[s][name] == 0: del self[s][name]
+        removed = count - remaining
+        if removed:
+            self.card_total[name] -= removed
+            if self.card_total[name] == 0: del self.card_total[name]
+        return removed
+
+def new_deck():
+    return Deck()
+
+# --- 三方合併 (JSON 字串)：別的 worker 在我們讀取之後也改了同一筆，把「我們的修改量」疊到對方的版本上 ---
+# 牌組逐張卡算：對方張數 + (我們 - 原本)；決鬥的數字欄位 (LP) 同樣算差值，其他欄位 (target) 用我們的
+# 任何一邊是新建/刪除就直接用我們的版本
+def merge_json(kind, base, ours, theirs):
+    if base is None or ours is None or theirs is None: return ours
+    b, o, t = json.loads(base), json.loads(ours), json.loads(theirs)
+    if kind == "deck":
+        merged = {}
+        for s in SECTIONS:
+            bs, os_, ts = b.get(s, {}), o.get(s, {}), t.get(s, {})
+            counts = {name: ts.get(name, 0) + os_.get(name, 0) - bs.get(name, 0) for name in dict.fromkeys([*ts, *os_])}
+            merged[s] = {name: count for name, count in counts.items() if count > 0}
+    else:
+        merged = {k: t[k] + v - b[k] if all(isinstance(d.get(k), int) for d in (b, t)) and isinstance(v, int) else v for k, v in o.items()}
+    return json.dumps(merged, ensure_ascii=False)
+
+# ==========================================
+# 牌組/決鬥持久化 (SQLite WAL + 記憶體快取 + 延遲批次寫入)
+# - 讀取：先看記憶體快取，沒有才查 SQLite；其他 worker 寫入時 (data_version 改變) 會清掉快取重讀
+# - 寫入：handler 改完資料後呼叫 save_deck()/save_duel()，當下就把資料序列化成 JSON 放進待寫區，
+#         背景執行緒每 flush_interval 秒把待寫區一次寫進同一個 transaction
+#         (例：一次輸入『青眼白龍*3 融合*1』只會變成一筆寫入，而不是每張卡一次 fsync)
+#         flush_interval=0 則每次修改馬上寫
+# - 多個 gunicorn worker 共用同一個檔案：每筆記著讀進來時的 updated_at (_base)，
+#   寫入前 (或重讀時) 發現別的 worker 已經改過，就用 merge_json 把待寫的修改疊到對方的版本上，不會整筆蓋掉
+#   待寫區的修改要等寫入後別的 worker 才看得到，最多晚 flush_interval 秒
+# ==========================================
+class DeckStore:
+    def __init__(self, path="decks.db", flush_interval=1.0, max_cached_users=5000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_cached_users = max_cached_users
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._decks = OrderedDict()   # user_id -> {deck_name: deck}
+        self._pending = {}            # ("deck", user_id, deck_name) / ("duel", user_id, None) -> JSON 或 None(刪除)
+        self._base = {}               # 同上的 key -> 最後一次讀到/寫入的 (updated_at, JSON)，沒有這筆是 (None, None)
+        self._merged_duels = set()    # 寫入時合併過的決鬥：app 手上的那份已經舊了，要重讀
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        self._wake = threading.Event()
+        self._closed = False
+        self.stats = {"flushes": 0, "rows_written": 0, "cache_hits": 0, "cache_misses": 0, "invalidations": 0, "merges": 0}
+        self._thread = threading.Thread(target=self._flusher, name="deck-store-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- 讀取 ---
+    def decks(self, user_id):
+        with self._lock:
+            self._check_external_writes()
+            if user_id in self._decks:
+                self.stats["cache_hits"] += 1
+                self._decks.move_to_end(user_id)
+                return self._decks[user_id]
+            self.stats["cache_misses"] += 1
+            rows = {name: (updated_at, data) for name, data, updated_at in
+                    self._db.execute("SELECT deck_name, data, updated_at FROM decks WHERE user_id = ?", (user_id,))}
+            for kind, uid, name in self._pending:
+                if kind == "deck" and uid == user_id: rows.setdefault(name, (None, None))
+            # 還沒寫進去的修改要蓋在 DB 資料上面 (DB 在這段期間被別的 worker 改過就先合併)
+            decks = {}
+            for name, current in rows.items():
+                data = self._rebase(("deck", user_id, name), current)
+                if data is not None: decks[name] = Deck(json.loads(data))
+            self._decks[user_id] = decks
+            self._evict()
+            return decks
+
+    # 決鬥的熱資料放在 app 的 session store，這裡不另外快取
+    # max_age：超過幾秒沒更新的決鬥視為已放棄 (例如重啟前就沒人理的對局)
+    def duel(self, user_id, max_age=None):
+        with self._lock:
+            key = ("duel", user_id, None)
+            self._merged_duels.discard(user_id)
+            updated_at, data = current = self._row(key)
+            if key in self._pending or (updated_at and (max_age is None or time.time() - updated_at <= max_age)):
+                data = self._rebase(key, current)
+            else:
+                self._base[key], data = current, None
+            return json.loads(data) if data else None
+
+    # app 記憶體裡那份決鬥還能不能用：別的 worker 寫過 (updated_at 和我們最後讀寫的不同) 就要重讀 duel()
+    def duel_changed(self, user_id):
+        key = ("duel", user_id, None)
+        with self._lock:
+            return user_id in self._merged_duels or self._row(key)[0] != self._base.get(key, (None, None))[0]
+
+    def _row(self, key):
+        kind, user_id, deck_name = key
+        if kind == "deck": row = self._db.execute("SELECT updated_at, data FROM decks WHERE user_id = ? AND deck_name = ?", (user_id, deck_name)).fetchone()
+        else: row = self._db.execute("SELECT updated_at, data FROM duels WHERE user_id = ?", (user_id,)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    # DB 目前是 current：比我們讀到的新、而我們還有待寫的修改，就把修改合併到新版本上；回傳合併後該看到的資料
+    def _rebase(self, key, current):
+        base = self._base.get(key, (None, None))
+        if key in self._pending and current[0] != base[0]:
+            self._pending[key] = merge_json(key[0], base[1], self._pending[key], current[1])
+            self.stats["merges"] += 1
+            if key[0] == "duel": self._merged_duels.add(key[1])
+            else: self._decks.pop(key[1], None)
+        self._base[key] = current
+        return self._pending[key] if key in self._pending else current[1]
+
+    # --- 寫入 (延遲批次) ---
+    def save_deck(self, user_id, deck_name, deck):
+        with self._lock:
+            self.decks(user_id)[deck_name] = deck
+            self._pending[("deck", user_id, deck_name)] = json.dumps(deck, ensure_ascii=False)
+        if not self.flush_interval: self._wake.set()
+
+    def delete_deck(self, user_id, deck_name):
+        with self._lock:
+            self.decks(user_id).pop(deck_name, None)
+            self._pending[("deck", user_id, deck_name)] = None
+        if not self.flush_interval: self._wake.set()
+
+    def save_duel(self, user_id, duel):
+        with self._lock:
+            self._pending[("duel", user_id, None)] = json.dumps(duel, ensure_ascii=False) if duel else None
+        if not self.flush_interval: self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending: return 0
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                # 拿到寫入鎖之後再比對一次，別的 worker 在這之後就改不了，合併完的結果不會再被蓋掉
+                for key in list(self._pending): self._rebase(key, self._row(key))
+                now = time.time()
+                batch = self._pending
+                deck_upserts = [(uid, name, data, now) for (kind, uid, name), data in batch.items() if kind == "deck" and data is not None]
+                deck_deletes = [(uid, name) for (kind, uid, name), data in batch.items() if kind == "deck" and data is None]
+                duel_upserts = [(uid, data, now) for (kind, uid, _), data in batch.items() if kind == "duel" and data is not None]
+                duel_deletes = [(uid,) for (kind, uid, _), data in batch.items() if kind == "duel" and data is None]
+                self._db.executemany("INSERT OR REPLACE INTO decks (user_id, deck_name, data, updated_at) VALUES (?, ?, ?, ?)", deck_upserts)
+                self._db.executemany("DELETE FROM decks WHERE user_id = ? AND deck_name = ?", deck_deletes)
+                self._db.executemany("INSERT OR REPLACE INTO duels (user_id, data, updated_at) VALUES (?, ?, ?)", duel_upserts)
+                self._db.executemany("DELETE FROM duels WHERE user_id = ?", duel_deletes)
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                # 待寫區原封不動 (持有鎖，這段期間不會有新修改)，下次再試
+                logger.exception("牌組寫入失敗，下次再試")
+                if self._db.in_transaction: self._db.execute("ROLLBACK")
+                return 0
+            self._pending = {}
+            for key, data in batch.items():
+                if data is None: self._base.pop(key, None)
+                else: self._base[key] = (now, data)
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += len(batch)
+            # 自己的 commit 不會改 data_version，但先讀一次避免誤判
+            self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            return len(batch)
+
+    def _flusher(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval or None)
+            self._wake.clear()
+            try: self.flush()
+            except Exception: logger.exception("牌組寫入執行緒發生錯誤")
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        self._wake.set()
+        self._thread.join(5)
+        self.flush()
+
+    # --- 快取維護 ---
+    def _check_external_writes(self):
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            # 別的 gunicorn worker 寫過 DB，清掉快取 (待寫區仍會蓋回去)
+            self._data_version = version
+            self._decks.clear()
+            self.stats["invalidations"] += 1
+
+    def _evict(self):
+        dirty_users = {uid for (_, uid, _) in self._pending}
+        for uid in list(self._decks):
+            if len(self._decks) <= self.max_cached_users: break
+            if uid not in dirty_users:
+                for name in self._decks.pop(uid): self._base.pop(("deck", uid, name), None)
+
+    # --- 匯入既有的記憶體資料 ({"user_id": {"白龍": {"main": {}, "extra": {}, "side": {}}}}) ---
+    def import_decks(self, user_decks, overwrite=False):
+        count = 0
+        for user_id, decks in user_decks.items():
+            existing = self.decks(user_id)
+            for deck_name, deck in decks.items():
+                if deck_name in existing and not overwrite: continue
+                self.save_deck(user_id, deck_name, Deck(deck))
+                count += 1
+        self.flush()
+        return count
+
+    def export_decks(self):
+        self.flush()
+        result = {}
+        with self._lock:
+            for user_id, deck_name, data in self._db.execute("SELECT user_id, deck_name, data FROM decks ORDER BY user_id, deck_name"):
+                result.setdefault(user_id, {})[deck_name] = json.loads(data)
+        return result
+
+# 用法：python deck_store.py import user_decks.json [decks.db]
+#       python deck_store.py export backup.json [decks.db]
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("import", "export"):
+        sys.exit("用法：python deck_store.py import|export <json 檔> [db 路徑]")
+    store = DeckStore(sys.argv[3] if len(sys.argv) > 3 else "decks.db")
+    if sys.argv[1] == "import":
+        with open(sys.argv[2], encoding="utf-8") as f:
+            print(f"已匯入 {store.import_decks(json.load(f))} 副牌組")
+    else:
+        with open(sys.argv[2], "w", encoding="utf-8") as f:
+            json.dump(store.export_decks(), f, ensure_ascii=False, indent=2)
+        print(f"已匯出至 {sys.argv[2]}")
+    store.close()
@@ -0,0 +1,173 @@
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 背景事件派送器 (每位使用者一條 FIFO)
+# /callback 驗完簽章後把事件丟進有上限的佇列，立刻回 OK，由共用的 worker 執行緒處理
+# 每個 user_id 有自己的佇列，同一時間最多一個 worker 在處理它：
+#   同一位使用者的事件嚴格依序執行；任何空閒的 worker 都能接別人的事件，不會被不相干的人卡住
+# worker 在等 Gemini 這類慢請求時用 blocking() 包起來，派送器會補一個 worker 頂上 (上限 max_threads)，
+#   等待中的使用者自己的後續事件仍排在後面，其他人照常處理
+# ==========================================
+class EventDispatcher:
+    def __init__(self, handle_fn, workers=4, maxsize=200, key_fn=None, submit_timeout=5.0, max_threads=None):
+        self.handle_fn = handle_fn
+        self.key_fn = key_fn or (lambda event: None)
+        self.workers = max(1, workers)
+        self.max_threads = max(self.workers, max_threads or self.workers * 4)
+        self.maxsize = maxsize
+        self.submit_timeout = submit_timeout
+        self._queues = {}       # key -> deque[(排入時間, event)]；key 在這裡代表它正在執行或等著被執行
+        self._ready = deque()   # 輪到可以執行的 key (正在執行的 key 不會在這裡，所以同一人不會被兩個 worker 同時處理)
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._pending = 0
+        self._threads = self._idle = self._blocked = 0
+        self._closed = False
+        self._stats = {"enqueued": 0, "rejected": 0, "processed": 0, "failed": 0,
+                       "busy": 0, "max_depth": 0, "peak_threads": 0, "wait_ms_total": 0.0, "run_ms_total": 0.0}
+
+    def start(self):
+        with self._cond:
+            for _ in range(self.workers): self._spawn()
+        return self
+
+    def _spawn(self):
+        self._threads += 1
+        self._stats["peak_threads"] = max(self._stats["peak_threads"], self._threads)
+        threading.Thread(target=self._worker, name=f"event-worker-{self._threads}", daemon=True).start()
+
+    # 有事件等著、沒有空閒 worker，且能動的 worker 不到 workers 個 (其他都在 blocking) 才補一個
+    def _maybe_spawn(self):
+        if self._ready and not self._idle and self._threads - self._blocked < self.workers and self._threads < self.max_threads:
+            self._spawn()
+
+    # --- 投遞事件：佇列滿了先等一下 (背壓)，timeout 內仍塞不進去就回傳 False ---
+    # 不能改成在呼叫端直接執行，否則會插隊到同一位使用者排隊中的事件前面
+    def submit(self, event, timeout=None):
+        key = self.key_fn(event)
+        if key is None: key = object()   # 沒有 user_id 的事件彼此不必排隊
+        with self._cond:
+            if self._closed: return False
+            if not self._cond.wait_for(lambda: self._pending < self.maxsize or self._closed,
+                                       self.submit_timeout if timeout is None else timeout) or self._closed:
+                self._stats["rejected"] += 1
+                return False
+            lane = self._queues.get(key)
+            if lane is None:
+                lane = self._queues[key] = deque()
+                self._ready.append(key)
+            lane.append((time.monotonic(), event))
+            self._pending += 1
+            self._stats["enqueued"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], self._pending)
+            self._maybe_spawn()
+            self._cond.notify_all()
+        return True
+
+    def depth(self):
+        return self._pending
+
+    def _worker(self):
+        self._local.worker = True
+        while True:
+            with self._cond:
+                while not self._ready:
+                    # 關閉中且沒事可做，或 blocking 結束後 worker 變多了，就讓這個 worker 退場
+                    if self._closed or self._threads - self._blocked > self.workers:
+                        self._threads -= 1
+                        self._cond.notify_all()
+                        return
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                key = self._ready.popleft()
+                queued_at, event = self._queues[key].popleft()
+                self._pending -= 1
+                self._stats["busy"] += 1
+                self._cond.notify_all()
+            started = time.monotonic()
+            try:
+                self.handle_fn(event)
+                ok = True
+            except Exception:
+                logger.exception("事件處理失敗")
+                ok = False
+            done = time.monotonic()
+            with self._cond:
+                # 同一位使用者還有事件就排到隊尾 (輪流處理，不讓一個人連續佔住 worker)
+                if self._queues[key]: self._ready.append(key)
+                else: del self._queues[key]
+                self._stats["busy"] -= 1
+                self._stats["processed" if ok else "failed"] += 1
+                self._stats["wait_ms_total"] += (started - queued_at) * 1000
+                self._stats["run_ms_total"] += (done - started) * 1000
+                self._cond.notify_all()
+
+    # --- handler 裡等慢請求時用：這段時間不算在 workers 內，其他使用者的事件交給別的 worker ---
+    @contextmanager
+    def blocking(self):
+        if not getattr(self._local, "worker", False):
+            yield
+            return
+        with self._cond:
+            self._blocked += 1
+            self._maybe_spawn()
+        try: yield
+        finally:
+            with self._cond: self._blocked -= 1
+
+    # --- 優雅關閉：不再收新事件，等已排入的事件處理完 ---
+    def shutdown(self, timeout=30):
+        with self._cond:
+            if self._closed: return
+            self._closed = True
+            self._cond.notify_all()
+            if not self._cond.wait_for(lambda: self._threads == 0, timeout):
+                logger.warning("關閉逾時，仍有 %d 個事件未處理", self._pending + self._stats["busy"])
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["depth"] = self._pending
+            s["users_queued"] = len(self._queues)
+            s["threads"], s["blocked"] = self._threads, self._blocked
+        done = s["processed"] + s["failed"]
+        s["capacity"] = self.maxsize
+        s["workers"] = self.workers
+        wait_ms, run_ms = s.pop("wait_ms_total"), s.pop("run_ms_total")
+        s["avg_wait_ms"] = round(wait_ms / done, 2) if done else 0.0
+        s["avg_run_ms"] = round(run_ms / done, 2) if done else 0.0
+        return s
+
+# ==========================================
+# 同步模式用的每人一把鎖：只讓同一位使用者的事件互斥，不同使用者不會因為分到同一段而互等
+# 沒人在用的鎖就丟掉，不會隨使用者數無限成長
+# ==========================================
+class UserLocks:
+    def __init__(self):
+        self._locks = {}    # key -> [lock, 使用中/等待中的人數]
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def get(self, key):
+        if key is None:
+            yield
+            return
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]: yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]: del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
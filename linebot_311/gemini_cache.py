@@ -0,0 +1,128 @@
+import re
+import time
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# 去掉空白與標點後再比對，「灰流麗 效果？」和「灰流麗效果」視為同一題
+_PUNCT = re.compile(r"[\s\W_]+", re.UNICODE)
+
+def normalize_query(text):
+    return _PUNCT.sub("", unicodedata.normalize("NFKC", text).lower())
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done, self.value, self.error = threading.Event(), None, None
+
+# ==========================================
+# Gemini 回答快取
+# - 以正規化後的問題當 key，LRU 上限 + TTL
+# - 可選擇存到 SQLite 檔 (重啟後仍有效)：開檔時與之後每 sweep_interval 秒清掉過期的，
+#   超過 max_rows 筆就從最早到期 (也就是最舊) 的開始刪
+# - single-flight：同一題同時有 N 個人問，只會打一次 Gemini，其他人等同一個結果
+# - scope 會併進 key (例如禁卡表版本)：回答內容跟著它變時，換版後自然查不到舊答案，舊的等過期/被清掉
+# ==========================================
+class ResponseCache:
+    def __init__(self, max_entries=2000, ttl=6 * 3600, path=None, max_rows=20000, sweep_interval=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.sweep_interval = sweep_interval
+        self._swept_at = 0.0
+        self._mem = OrderedDict()  # key -> (expires_at, text, cost_ms)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, text TEXT NOT NULL, cost_ms REAL NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS answers_expires_at ON answers (expires_at)")
+        self.stats = {"hits": 0, "misses": 0, "joined": 0, "errors": 0, "saved_ms": 0.0, "rows_deleted": 0}
+        if self._db is not None: self._sweep()
+
+    def get_or_compute(self, query, compute, scope=None):
+        key = normalize_query(query)
+        if not key: return compute()
+        if scope: key = f"{scope}|{key}"
+        with self._lock:
+            hit = self._lookup(key)
+            if hit is not None:
+                self.stats["hits"] += 1
+                self.stats["saved_ms"] += hit[1]
+                return hit[0]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.stats["misses"] += 1
+            else:
+                self.stats["joined"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error: raise flight.error
+            with self._lock: self.stats["saved_ms"] += self._mem.get(key, (0, None, 0.0))[2]
+            return flight.value
+
+        started = time.monotonic()
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            with self._lock: self.stats["errors"] += 1
+            raise
+        finally:
+            cost_ms = (time.monotonic() - started) * 1000
+            with self._lock:
+                if flight.error is None and flight.value: self._store(key, flight.value, cost_ms)
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+    def _lookup(self, key):
+        now = time.time()
+        item = self._mem.get(key)
+        if item and item[0] > now:
+            self._mem.move_to_end(key)
+            return item[1], item[2]
+        if item: del self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT text, cost_ms, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row and row[2] > now:
+                self._remember(key, row[2], row[0], row[1])
+                return row[0], row[1]
+        return None
+
+    def _store(self, key, text, cost_ms):
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, text, cost_ms)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO answers (key, text, cost_ms, expires_at) VALUES (?, ?, ?, ?)", (key, text, cost_ms, expires_at))
+            if time.time() - self._swept_at >= self.sweep_interval: self._sweep()
+
+    def _sweep(self):
+        now = self._swept_at = time.time()
+        deleted = self._db.execute("DELETE FROM answers WHERE expires_at <= ?", (now,)).rowcount
+        if self.max_rows:
+            deleted += self._db.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                                        (self.max_rows,)).rowcount
+        self.stats["rows_deleted"] += deleted
+
+    def _remember(self, key, expires_at, text, cost_ms):
+        self._mem[key] = (expires_at, text, cost_ms)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries: self._mem.popitem(last=False)
+
+    def snapshot_stats(self):
+        with self._lock:
+            s = dict(self.stats)
+            s["size"] = len(self._mem)
+            s["inflight"] = len(self._flights)
+        total = s["hits"] + s["misses"] + s["joined"]
+        s["hit_rate"] = round((s["hits"] + s["joined"]) / total, 3) if total else 0.0
+        s["saved_ms"] = round(s["saved_ms"], 1)
+        return s
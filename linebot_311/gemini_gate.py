@@ -0,0 +1,117 @@
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 額度用完 (429) 或伺服器暫時出錯 (5xx) 才值得重試
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+class GateTimeout(Exception):
+    pass
+
+def is_retryable(error):
+    return getattr(error, "code", None) in RETRYABLE_CODES
+
+# ==========================================
+# 每分鐘額度 (token bucket)，per_minute <= 0 代表不限制
+# 用「先扣再等」的預約方式：額度不夠時餘額會變負的，後來的人自然排在後面，不必輪詢
+# ==========================================
+class TokenBucket:
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        if self.rate <= 0: return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    # 預估錯了就補扣/退回 (delta < 0 代表退回)
+    def adjust(self, delta):
+        if self.rate <= 0: return
+        with self._lock: self.tokens = min(self.capacity, self.tokens - delta)
+
+# ==========================================
+# 所有 Gemini 呼叫共用的閘門
+#   1. 每分鐘請求數 (rpm) 與 token 數 (tpm) 兩個 token bucket
+#   2. 同時進行中的請求最多 max_inflight 個
+#   3. 429 / 5xx 用 full jitter 指數退避重試
+# 每次呼叫都帶 deadline (time.time())，等不到額度或重試會超過 deadline 就放棄，不會一直卡著
+# ==========================================
+class GeminiGate:
+    def __init__(self, rpm=0, tpm=0, max_inflight=8, max_retries=3, base_delay=1.0, max_delay=16.0, default_timeout=60.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.default_timeout = default_timeout
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.stats = {"calls": 0, "throttled": 0, "wait_ms": 0.0, "retries": 0, "timeouts": 0, "failures": 0, "peak_inflight": 0}
+
+    def call(self, fn, tokens=1, deadline=None):
+        deadline = deadline or time.time() + self.default_timeout
+        with self._lock: self.stats["calls"] += 1
+        for attempt in range(self.max_retries + 1):
+            self._admit(tokens, deadline)
+            try: return self._run(fn)
+            except Exception as e:
+                self.tokens.adjust(-tokens)
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if not is_retryable(e) or attempt == self.max_retries or time.time() + delay > deadline:
+                    with self._lock: self.stats["failures"] += 1
+                    raise
+                logger.info("Gemini 請求失敗 (%s)，%.1f 秒後重試 (%d/%d)", getattr(e, "code", e), delay, attempt + 1, self.max_retries)
+                with self._lock: self.stats["retries"] += 1
+                time.sleep(delay)
+
+    # 等 rpm / tpm 額度，再等同時請求數的空位；任何一步會超過 deadline 就放棄
+    def _admit(self, tokens, deadline):
+        started = time.time()
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if started + wait > deadline: self._reject(tokens)
+        if wait: time.sleep(wait)
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.time())): self._reject(tokens)
+        with self._lock:
+            waited = time.time() - started
+            if waited > 0.05: self.stats["throttled"] += 1
+            self.stats["wait_ms"] += waited * 1000
+            self.inflight += 1
+            self.stats["peak_inflight"] = max(self.stats["peak_inflight"], self.inflight)
+
+    def _run(self, fn):
+        try: return fn()
+        finally:
+            with self._lock: self.inflight -= 1
+            self._slots.release()
+
+    # 放棄時把預扣的額度退回去
+    def _reject(self, tokens):
+        self.requests.adjust(-1)
+        self.tokens.adjust(-tokens)
+        with self._lock: self.stats["timeouts"] += 1
+        raise GateTimeout("等待 Gemini 額度逾時")
+
+    # 預估的 token 數和實際用量的差額，算完再補扣/退回
+    def settle(self, estimated, actual):
+        if actual: self.tokens.adjust(actual - estimated)
+
+    def snapshot_stats(self):
+        with self._lock:
+            s = dict(self.stats)
+            s["inflight"] = self.inflight
+        s["wait_ms"] = round(s["wait_ms"], 1)
+        s["max_inflight"] = self.max_inflight
+        return s
@@ -0,0 +1,174 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from gemini_cache import normalize_query
+from banlist import LIMIT_TW
+from metrics import stage, GEMINI_TOKENS
+from lazy import lazy_import
+
+types = lazy_import("google.genai.types")
+
+logger = logging.getLogger(__name__)
+
+# 固定的裁判設定，所有請求都一樣 -> 建成 Gemini 快取內容重複使用，不必每次重送
+JUDGE_PERSONA = """你是一位專精「遊戲王 OCG 賽制」的裁判。現在是2026年，嚴格根據最新環境回答。
+回答規則：
+1. 問題前面若附有【本地資料】，卡片名稱、效果文字、禁卡表與裁定一律以本地資料為準，不要自行改寫效果。
+2. 本地資料沒有提到的部分，才依你的知識或搜尋結果補充，並說明是補充內容。
+3. 效果處理請依連鎖順序、發動條件、對象取得與否逐步說明，最後給出明確結論。
+4. 使用繁體中文回答，卡名以台灣常用譯名為主，必要時附上日文原名。
+5. 回答精簡，不要重複問題，不要加上與問題無關的行銷或問候語。"""
+
+# 問到環境、新卡這類時效性內容，本地資料再完整也要上網查
+FRESH_WORDS = re.compile(r'環境|最新|上位|主流|強度|熱門|tier|meta|賽事|大賽|比賽|新卡|新彈|發售|預組|補充包', re.IGNORECASE)
+
+# ==========================================
+# 本地檢索：從卡片資料庫、禁卡表、裁定檔找出和問題有關的資料
+# 裁定檔 (RULINGS_PATH，可省略)：{"灰流麗": ["裁定 1", "裁定 2"], ...}，卡名中日英皆可
+# 找得到相關卡片 (且不是問時效性內容) 就算命中，不必開 google_search
+# ==========================================
+class Retriever:
+    def __init__(self, card_db, banlist=None, rulings_path=None, max_cards=3):
+        self.card_db = card_db
+        self.banlist = banlist
+        self.max_cards = max_cards
+        self.rulings = {}
+        if rulings_path and os.path.exists(rulings_path):
+            with open(rulings_path, encoding="utf-8") as f:
+                self.rulings = {normalize_query(name): items for name, items in json.load(f).items()}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def card_context(self, card, ban_version=None):
+        names = [n for n in (card["name_zh"], card["name_ja"], card["name_en"]) if n]
+        section = "額外牌組" if card["section"] == "extra" else "主牌組"
+        text = f"【{' / '.join(names)}】{card['type'] or '-'} ({section})\n效果：{card['desc'] or '(無效果文字)'}"
+        if self.banlist and ban_version:
+            limit = min(self.banlist.limit(n, ban_version) for n in names)
+            text += f"\n禁卡表({ban_version})：{LIMIT_TW[limit]}"
+        rulings = next((self.rulings[norm] for n in names if (norm := normalize_query(n)) in self.rulings), [])
+        if rulings: text += "\n裁定：" + "；".join(rulings)
+        return text
+
+    # 回傳 (本地資料文字, 是否命中)
+    def retrieve(self, question):
+        cards = self.card_db.mentions(question, limit=self.max_cards) if self.card_db else []
+        ban_version = self.banlist.current_version if self.banlist else None
+        context = "\n\n".join(self.card_context(card, ban_version) for card in cards)
+        hit = bool(cards) and not FRESH_WORDS.search(question)
+        self.stats["hits" if hit else "misses"] += 1
+        return context, hit
+
+# 送出前粗估 token 數給 tpm 限流用 (中文約一字一 token、一張圖約一千多 token，再加回答)，算完再依實際用量修正
+def estimate_tokens(contents, grounded, image_tokens=1300, output_tokens=800):
+    parts = contents if isinstance(contents, list) else [contents]
+    size = sum(len(p) if isinstance(p, str) else image_tokens for p in parts) + output_tokens
+    return size * 2 if grounded else size
+
+def build_prompt(question, context):
+    return f"【本地資料】\n{context}\n\n【問題】\n{question}" if context else question
+
+# ==========================================
+# Gemini 呼叫統一從這裡走
+# - 裁判設定 (+ 是否開 google_search) 建成 cached content，之後只送問題本身
+#   模型不支援或設定太短建不了快取時，改用預先建好的設定物件 (固定前綴仍可吃到隱式快取)，過一段時間 (每次失敗加倍) 再試
+#   建快取也是一次 Gemini 請求：在鎖外面建、經過 gate 限流，同一時間只有一個請求在建，其他請求先用一般設定
+# - 每次請求記錄 token 數與延遲，/stats 看累計
+# - 有 gate 時所有呼叫都經過 GeminiGate (限流、重試、deadline)
+# ==========================================
+class JudgeModel:
+    def __init__(self, client, model, persona=JUDGE_PERSONA, use_cache=True, cache_ttl=3600, gate=None, retry_delay=30.0):
+        self.client = client
+        self.gate = gate
+        self.model = model
+        self.persona = persona
+        self.use_cache = use_cache
+        self.cache_ttl = cache_ttl
+        self.retry_delay = retry_delay
+        self._caches = {}    # grounded -> (cache name, 到期時間)
+        self._creating = set()
+        self._failures = {}  # grounded -> (連續失敗次數, 下次可以再試的時間)
+        self._inline = {}    # grounded -> 不用快取時的設定 (第一次用到才建，才不會一啟動就載入 google.genai)
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    @staticmethod
+    def _tools(grounded):
+        return [{"google_search": {}}] if grounded else None
+
+    def _inline_config(self, grounded):
+        if grounded not in self._inline:
+            self._inline[grounded] = types.GenerateContentConfig(system_instruction=self.persona, tools=self._tools(grounded))
+        return self._inline[grounded]
+
+    # 快取快到期 (剩不到 60 秒) 就重建；別人正在建或還在失敗後的等待期間，舊快取沒過期就繼續用，否則用一般設定
+    def _config(self, grounded, deadline=None):
+        if not self.use_cache: return self._inline_config(grounded)
+        now = time.monotonic()
+        with self._lock:
+            name, expires_at = self._caches.get(grounded, (None, 0))
+            failures, retry_at = self._failures.get(grounded, (0, 0))
+            if now < expires_at - 60 or grounded in self._creating or now < retry_at:
+                return types.GenerateContentConfig(cached_content=name) if now < expires_at else self._inline_config(grounded)
+            self._creating.add(grounded)
+        try:
+            cache = self._create_cache(grounded, deadline)
+        except Exception as e:
+            delay = min(self.cache_ttl, self.retry_delay * 2 ** failures)
+            with self._lock:
+                self._failures[grounded] = (failures + 1, time.monotonic() + delay)
+                self._creating.discard(grounded)
+            logger.warning("裁判設定無法建立快取，%.0f 秒內改用一般設定：%s", delay, e)
+            return types.GenerateContentConfig(cached_content=name) if time.monotonic() < expires_at else self._inline_config(grounded)
+        with self._lock:
+            self._caches[grounded] = (cache.name, time.monotonic() + self.cache_ttl)
+            self._failures.pop(grounded, None)
+            self._creating.discard(grounded)
+        return types.GenerateContentConfig(cached_content=cache.name)
+
+    def _create_cache(self, grounded, deadline):
+        create = lambda: self.client.caches.create(model=self.model, config=types.CreateCachedContentConfig(
+            system_instruction=self.persona, tools=self._tools(grounded), ttl=f"{self.cache_ttl}s",
+            display_name=f"judge-persona-{'search' if grounded else 'local'}"))
+        if self.gate is None: return create()
+        return self.gate.call(create, estimate_tokens(self.persona, grounded, output_tokens=0), deadline)
+
+    def generate(self, contents, grounded, label="text", deadline=None):
+        started = time.monotonic()
+        with stage("gemini"): response = self._call(contents, grounded, deadline)
+        self._record(label, grounded, response.usage_metadata, (time.monotonic() - started) * 1000)
+        return response.text
+
+    # 設定在 gate 外面先準備好：建快取要另外排 gate，不能佔著這個請求的名額再排一次
+    def _call(self, contents, grounded, deadline):
+        config = self._config(grounded, deadline)
+        call = lambda: self.client.models.generate_content(model=self.model, contents=contents, config=config)
+        if self.gate is None: response = call()
+        else:
+            estimated = estimate_tokens(contents, grounded)
+            response = self.gate.call(call, estimated, deadline)
+            self.gate.settle(estimated, getattr(response.usage_metadata, "total_token_count", None))
+        return response
+
+    def _record(self, label, grounded, usage, ms):
+        tokens = {key: (getattr(usage, f"{key}_token_count", None) or 0) if usage else 0
+                  for key in ("prompt", "cached_content", "candidates", "thoughts", "tool_use_prompt", "total")}
+        logger.info("gemini %s grounded=%s %.0fms prompt=%d cached=%d output=%d thoughts=%d tool=%d total=%d", label, grounded, ms,
+                    tokens["prompt"], tokens["cached_content"], tokens["candidates"], tokens["thoughts"], tokens["tool_use_prompt"], tokens["total"])
+        with self._lock:
+            s = self.stats.setdefault(f"{label}_{'search' if grounded else 'local'}", {"calls": 0, "ms": 0.0, **{k: 0 for k in tokens}})
+            s["calls"] += 1
+            s["ms"] += ms
+            for key, count in tokens.items(): s[key] += count
+        for key in ("prompt", "cached_content", "candidates", "thoughts", "tool_use_prompt"):
+            if tokens[key]: GEMINI_TOKENS.labels(label, key).inc(tokens[key])
+
+    def snapshot_stats(self):
+        with self._lock:
+            result = {key: {**s, "ms": round(s["ms"], 1), "avg_ms": round(s["ms"] / s["calls"], 1),
+                            "avg_total_tokens": round(s["total"] / s["calls"], 1)} for key, s in self.stats.items()}
+        result["persona_cache"] = self.use_cache
+        return result
@@ -0,0 +1,82 @@
+import math
+import random
+from functools import lru_cache
+
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# ==========================================
+# 起手機率計算
+# - 單一卡片/卡片群組：超幾何分佈精確計算「起手至少抽到 k 張」的機率
+# - 多個條件同時成立 (例：至少 1 張展開點 且 至少 1 張手坑)：NumPy 一次模擬 10 萬手以上
+# 結果依「主牌組內容 + 查詢條件」快取，牌組沒改過就直接回傳
+# ==========================================
+HAND_SIZES = (5, 6)  # 先攻 5 張 / 後攻 6 張
+
+def hypergeom_at_least(deck_size, hits, hand, k=1):
+    total = math.comb(deck_size, hand)
+    return sum(math.comb(hits, i) * math.comb(deck_size - hits, hand - i)
+               for i in range(k, min(hits, hand) + 1)) / total
+
+def simulate(counts, groups, hand, trials, seed=0):
+    # counts: 每種卡的張數；groups: [(所屬卡種 index 集合, 最少張數)]
+    card_of = np.repeat(np.arange(len(counts)), counts)
+    member = np.zeros((len(groups), len(counts)), dtype=np.int8)
+    for g, (kinds, _) in enumerate(groups): member[g, list(kinds)] = 1
+    mins = np.array([k for _, k in groups])
+    rng = np.random.default_rng(seed)
+    ok = 0
+    # 分批做，避免 trials x 牌組張數 的矩陣太大
+    for start in range(0, trials, 50_000):
+        n = min(50_000, trials - start)
+        hands = np.argpartition(rng.random((n, len(card_of))), hand - 1, axis=1)[:, :hand]
+        kinds_in_hand = card_of[hands]                                  # (n, hand)
+        per_group = member[:, kinds_in_hand].sum(axis=2).T               # (n, groups)
+        ok += int(np.count_nonzero((per_group >= mins).all(axis=1)))
+    return ok / trials
+
+@lru_cache(maxsize=512)
+def opening_odds(main_items, groups, trials=100_000, joint=True):
+    names = [n for n, _ in main_items]
+    counts = [c for _, c in main_items]
+    deck_size = sum(counts)
+    index = {n: i for i, n in enumerate(names)}
+    result = {"deck_size": deck_size, "groups": [], "joint": None}
+    resolved = []
+    for label, members, k in groups:
+        kinds = frozenset(index[m] for m in members if m in index)
+        hits = sum(counts[i] for i in kinds)
+        result["groups"].append((label, hits, k, [hypergeom_at_least(deck_size, hits, h, k) if deck_size >= h else 0.0 for h in HAND_SIZES]))
+        resolved.append((kinds, k))
+    if joint and len(resolved) > 1:
+        result["joint"] = [simulate(counts, resolved, h, trials, seed=h) if deck_size >= h else 0.0 for h in HAND_SIZES]
+    return result
+
+# --- 解析查詢：「先攻=青眼白龍,融合 手坑=灰流麗、增殖的G 青眼白龍:2」 ---
+# 空白分隔群組；群組內用 , 或 、 分隔；「名稱=」可替群組命名；「:k」代表至少 k 張
+def parse_groups(text, resolve_name=lambda n: n):
+    groups = []
+    for token in text.split():
+        label, _, body = token.rpartition("=")
+        body, _, k = body.partition(":")
+        members = tuple(resolve_name(m) for m in body.replace("、", ",").split(",") if m)
+        if not members: continue
+        groups.append((label or "+".join(members), members, int(k) if k.isdigit() and int(k) > 0 else 1))
+    return tuple(groups)
+
+def deck_key(deck):
+    return tuple(sorted(deck["main"].items()))
+
+def format_odds(deck_name, result, trials):
+    text = f"🎴 【{deck_name}】起手機率 (主牌組 {result['deck_size']}張)\n➖➖➖➖➖➖\n"
+    for label, hits, k, (p5, p6) in result["groups"]:
+        text += f"▪️ {label} ({hits}張，至少{k}張)\n   先攻5張 {p5:.1%} / 後攻6張 {p6:.1%}\n"
+    if result["joint"]:
+        p5, p6 = result["joint"]
+        text += f"\n🔗 全部條件同時成立 (模擬 {trials:,} 手)\n   先攻5張 {p5:.1%} / 後攻6張 {p6:.1%}"
+    return text.strip()
+
+def draw_hand(deck, hand=HAND_SIZES[0]):
+    pool = [name for name, count in deck["main"].items() for _ in range(count)]
+    return random.sample(pool, min(hand, len(pool)))
@@ -0,0 +1,59 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 多張照片合併辨識
+# 同一組圖片 (image_set.id 相同) 或同一位使用者在 window 秒內連續傳的圖片收集成一批，
+# 湊齊 (收到 total 張) 或時間到就交給 flush_fn(events, prefetched) 一次處理
+# prefetched 是 add() 時一起交進來的東西 (例如已經開始的下載)，和 events 一一對應：等待只延後合併的那次請求，不延後下載
+# flush_fn 在背景執行緒執行，add() 本身不會卡住呼叫端 (也不會擋住同一條 lane 後面的圖片)
+# ==========================================
+class ImageBatcher:
+    def __init__(self, flush_fn, window=1.0, set_timeout=5.0, max_batch=10):
+        self.flush_fn = flush_fn
+        self.window = window
+        self.set_timeout = set_timeout
+        self.max_batch = max_batch
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.stats = {"images": 0, "batches": 0, "max_batch_size": 0}
+
+    @staticmethod
+    def group_key(event):
+        image_set = getattr(event.message, "image_set", None)
+        if image_set is not None and image_set.id:
+            return ("set", image_set.id), image_set.total
+        return ("user", event.source.user_id), None
+
+    # 回傳 True 代表這張是新的一批的第一張 (呼叫端可以在這時候顯示讀取動畫)
+    def add(self, event, prefetched=None):
+        key, total = self.group_key(event)
+        with self._lock:
+            self.stats["images"] += 1
+            group = self._groups.get(key)
+            is_new = group is None
+            if is_new:
+                timeout = self.set_timeout if key[0] == "set" else self.window
+                group = self._groups[key] = {"events": [], "total": total,
+                                             "timer": threading.Timer(timeout, self._flush, args=(key,))}
+                group["timer"].daemon = True
+                group["timer"].start()
+            group["events"].append((event, prefetched))
+            full = len(group["events"]) >= min(group["total"] or self.max_batch, self.max_batch)
+        if full:
+            group["timer"].cancel()
+            threading.Thread(target=self._flush, args=(key,), daemon=True).start()
+        return is_new
+
+    def _flush(self, key):
+        with self._lock:
+            group = self._groups.pop(key, None)
+            if group is None: return
+            self.stats["batches"] += 1
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(group["events"]))
+        # 圖片組的 index 從 1 開始，依原本順序排好
+        items = sorted(group["events"], key=lambda item: getattr(getattr(item[0].message, "image_set", None), "index", 0) or 0)
+        try: self.flush_fn([e for e, _ in items], [p for _, p in items])
+        except Exception: logger.exception("圖片批次處理失敗")
@@ -0,0 +1,119 @@
+import time
+import sqlite3
+import threading
+
+from lazy import lazy_import
+
+Image, ImageOps = lazy_import("PIL.Image"), lazy_import("PIL.ImageOps")
+
+# ==========================================
+# 卡片照片的感知雜湊 (dHash)
+# 輸入是 find_card_box 裁出的卡片範圍 (不是整張照片，否則同一張桌墊上的不同卡雜湊會很接近)
+# 轉灰階 -> 再裁掉外圍 (卡框、沒裁乾淨的桌面) -> 縮成 9x8 -> 比較左右相鄰像素，得到 64 bit
+# 同一張卡換個角度/光線重拍，雜湊只會差幾個 bit
+# ==========================================
+def dhash(img, crop=0.08):
+    img = ImageOps.exif_transpose(img).convert("L")
+    w, h = img.size
+    dx, dy = int(w * crop), int(h * crop)
+    img = img.crop((dx, dy, w - dx, h - dy)).resize((9, 8), Image.LANCZOS)
+    px = img.load()
+    value = 0
+    for y in range(8):
+        for x in range(8):
+            value = (value << 1) | (px[x, y] > px[x + 1, y])
+    return value
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+# sqlite 只收 signed 64 bit
+def _to_db(h): return h - (1 << 64) if h >= (1 << 63) else h
+def _from_db(h): return h + (1 << 64) if h < 0 else h
+
+# ==========================================
+# 已辨識卡片的索引 (multi-index hashing)
+# 64 bit 切成 max_distance+1 段，依鴿籠原理：距離 <= max_distance 的兩個雜湊至少有一段完全相同
+# 所以只要查每一段的 bucket 再逐一算距離，資料量到數萬筆也只需要比對少數候選
+# 回覆裡有禁卡表狀態，所以每筆記下當時的禁卡表版本：版本一換就清掉舊版本的紀錄；超過 ttl 秒的也不再使用
+# ==========================================
+class ImageHashIndex:
+    def __init__(self, path="image_hashes.db", max_distance=6, ttl=None):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        bands = max_distance + 1
+        self._bands = [(i * 64 // bands, (i + 1) * 64 // bands) for i in range(bands)]
+        self._buckets = [{} for _ in self._bands]  # 每段的值 -> [hash...]
+        self._answers = {}                          # hash -> (建立時間, 禁卡表版本, 回覆文字)
+        self._version = None
+        self._swept_at = time.time()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS image_hashes (hash INTEGER PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL)")
+        # 舊的資料檔沒有版本欄，當作版本不明 (禁卡表一載入就會被清掉)
+        if "version" not in [row[1] for row in self._db.execute("PRAGMA table_info(image_hashes)")]:
+            self._db.execute("ALTER TABLE image_hashes ADD COLUMN version TEXT")
+        if ttl: self._db.execute("DELETE FROM image_hashes WHERE created_at < ?", (time.time() - ttl,))
+        for h, text, created_at, version in self._db.execute("SELECT hash, text, created_at, version FROM image_hashes"):
+            self._add(_from_db(h), text, created_at, version)
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "invalidated": 0}
+
+    def _band_keys(self, h):
+        return [(h >> lo) & ((1 << (hi - lo)) - 1) for lo, hi in self._bands]
+
+    def _add(self, h, text, created_at, version):
+        if h not in self._answers:
+            for bucket, key in zip(self._buckets, self._band_keys(h)):
+                bucket.setdefault(key, []).append(h)
+        self._answers[h] = (created_at, version, text)
+
+    def _remove(self, hashes):
+        for h in hashes:
+            del self._answers[h]
+            for bucket, key in zip(self._buckets, self._band_keys(h)):
+                bucket[key].remove(h)
+                if not bucket[key]: del bucket[key]
+
+    # 禁卡表換版：舊版本的回覆全部作廢 (記憶體與資料檔都清掉)
+    def _check_version(self, version):
+        if version == self._version: return
+        self._version = version
+        stale = [h for h, (_, v, _) in self._answers.items() if v != version]
+        self._remove(stale)
+        self.stats["invalidated"] += len(stale)
+        self._db.execute("DELETE FROM image_hashes WHERE version IS NOT ?", (version,))
+
+    # 過期的紀錄查詢時直接跳過，每 ttl/10 秒順便從索引清掉一次
+    def _sweep(self, now):
+        if not self.ttl or now - self._swept_at < self.ttl / 10: return
+        self._swept_at = now
+        expired = [h for h, (created_at, _, _) in self._answers.items() if created_at < now - self.ttl]
+        self._remove(expired)
+        self.stats["expired"] += len(expired)
+        self._db.execute("DELETE FROM image_hashes WHERE created_at < ?", (now - self.ttl,))
+
+    def lookup(self, h, version=None):
+        with self._lock:
+            self._check_version(version)
+            now = time.time()
+            self._sweep(now)
+            best, best_d = None, self.max_distance + 1
+            for bucket, key in zip(self._buckets, self._band_keys(h)):
+                for cand in bucket.get(key, ()):
+                    d = hamming(h, cand)
+                    if d < best_d and not (self.ttl and self._answers[cand][0] < now - self.ttl): best, best_d = cand, d
+            self.stats["hits" if best is not None else "misses"] += 1
+            return self._answers[best][2] if best is not None else None
+
+    def add(self, h, text, version=None):
+        with self._lock:
+            self._check_version(version)
+            now = time.time()
+            self._add(h, text, now, version)
+            self._db.execute("INSERT OR REPLACE INTO image_hashes (hash, text, created_at, version) VALUES (?, ?, ?, ?)",
+                             (_to_db(h), text, now, version))
+
+    def snapshot_stats(self):
+        with self._lock:
+            return {**self.stats, "size": len(self._answers), "max_distance": self.max_distance, "version": self._version}
@@ -0,0 +1,71 @@
+import io
+
+from lazy import lazy_import
+
+Image, ImageOps, ImageFilter = lazy_import("PIL.Image"), lazy_import("PIL.ImageOps"), lazy_import("PIL.ImageFilter")
+
+CARD_RATIO = 59 / 86  # 遊戲王卡 寬:高
+
+# ==========================================
+# 上傳 Gemini 前的前處理
+# 1. 依 EXIF 轉正  2. 長邊縮到 max_edge  3. (可選) 裁到卡片範圍
+# 4. 重新壓成 JPEG/WebP，逐步降畫質直到小於 max_bytes
+# 手機原圖 3~12MP、好幾 MB，處理後通常只剩 100~300KB，辨識結果不受影響
+# 另外回傳卡片範圍的圖 (不論上傳時裁不裁) 給雜湊快取用：同一張桌墊上的不同卡，整張照片的雜湊常常只差幾個 bit
+# 找不到卡片外框時回傳 None，這張照片就不查也不寫雜湊快取
+# ==========================================
+def prepare_image(data, max_edge=1280, crop_card=False, fmt="JPEG", max_bytes=350_000):
+    img = Image.open(io.BytesIO(data))
+    # JPEG 可以直接用 1/2、1/4、1/8 倍率解碼，省掉大部分解碼時間 (要裁切時多留一倍解析度)
+    edge = max_edge * (2 if crop_card else 1)
+    img.draft("RGB", (edge, edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+    box = find_card_box(img)
+    card = img.crop(box) if box else None
+    if crop_card and card: img = card.copy()
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    out = b""
+    for quality in (85, 75, 65, 55, 45):
+        out = encode(img, fmt, quality)
+        if len(out) <= max_bytes: break
+    while len(out) > max_bytes and min(img.size) > 256:
+        img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
+        out = encode(img, fmt, 45)
+    return img, out, "image/webp" if fmt.upper() == "WEBP" else "image/jpeg", card
+
+def encode(img, fmt, quality):
+    buf = io.BytesIO()
+    extra = {"optimize": True} if fmt.upper() == "JPEG" else {"method": 4}
+    img.save(buf, format=fmt.upper(), quality=quality, **extra)
+    return buf.getvalue()
+
+# --- 粗略找卡片外框：邊緣圖中「夠多邊緣點」的列/欄範圍，再修正成卡片比例 ---
+# 找不到合理範圍就回傳 None，維持整張圖
+def find_card_box(img, work=256, density=0.08):
+    small = img.convert("L")
+    small.thumbnail((work, work))
+    w, h = small.size
+    # FIND_EDGES 會把圖片最外圈當成邊緣，先去掉 2px 外框
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v > 40 else 0).crop((2, 2, w - 2, h - 2))
+    px = edges.load()
+    cols = [sum(1 for y in range(h - 4) if px[x, y]) for x in range(w - 4)]
+    rows = [sum(1 for x in range(w - 4) if px[x, y]) for y in range(h - 4)]
+    xs = [x + 2 for x, c in enumerate(cols) if c > h * density]
+    ys = [y + 2 for y, c in enumerate(rows) if c > w * density]
+    if not xs or not ys: return None
+    x0, x1, y0, y1 = xs[0], xs[-1], ys[0], ys[-1]
+    bw, bh = x1 - x0, y1 - y0
+    if bw < w * 0.3 or bh < h * 0.3: return None
+
+    # 直拍或橫拍都允許，補成卡片比例 (只放大不縮小，避免切到卡面)
+    ratio = CARD_RATIO if bh >= bw else 1 / CARD_RATIO
+    if bw / bh < ratio:
+        pad = (bh * ratio - bw) / 2
+        x0, x1 = x0 - pad, x1 + pad
+    else:
+        pad = (bw / ratio - bh) / 2
+        y0, y1 = y0 - pad, y1 + pad
+    sx, sy = img.width / w, img.height / h
+    return (max(0, int(x0 * sx)), max(0, int(y0 * sy)), min(img.width, int(x1 * sx) + 1), min(img.height, int(y1 * sy) + 1))
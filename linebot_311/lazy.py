@@ -0,0 +1,100 @@
+import time
+import logging
+import importlib
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 延遲載入：google.genai、linebot.v3 的 model、PIL、numpy 光是 import 就要好幾秒
+# Lazy(factory, name) 是代理物件，第一次取屬性/呼叫時才真的 import / 建立，之後都轉給真正的物件
+#   有 __name__ (註冊 handler 用)，也能放在 isinstance 第二個參數，所以原本的寫法不必改
+# 所有 Lazy 都記在 _registry：load_all() 一次全部載入 (預設啟動方式)，warmup() 則在背景慢慢載
+# 每一段 import / 建立花多久記在 LOAD_TIMES (扣掉巢狀載入的時間)，開機時印成 import 耗時表
+#   耗時按 label (模組) 合計；pending() 則逐一列出還沒用過的代理 (target，例如 linebot.v3.messaging.TextMessage)
+# ==========================================
+LOAD_TIMES = {}
+_registry = []
+_local = threading.local()
+_MISSING = object()
+
+@contextmanager
+def timed(name):
+    outer, _local.nested = getattr(_local, "nested", 0.0), 0.0
+    started = time.perf_counter()
+    try: yield
+    finally:
+        seconds = time.perf_counter() - started
+        LOAD_TIMES[name] = LOAD_TIMES.get(name, 0.0) + seconds - _local.nested
+        _local.nested = outer + seconds
+
+class Lazy:
+    def __init__(self, factory, name, label=None, target=None):
+        self.__name__ = name
+        self._lazy_factory = factory
+        self._lazy_label = label or name
+        self._lazy_target = target or self._lazy_label
+        self._lazy_value = _MISSING
+        self._lazy_lock = threading.Lock()
+        _registry.append(self)
+
+    def _lazy_get(self):
+        value = self._lazy_value
+        if value is _MISSING:
+            with self._lazy_lock:
+                if self._lazy_value is _MISSING:
+                    with timed(self._lazy_label): self._lazy_value = self._lazy_factory()
+                value = self._lazy_value
+        return value
+
+    def __getattr__(self, item):
+        if item.startswith("_lazy_"): raise AttributeError(item)
+        return getattr(self._lazy_get(), item)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_get()(*args, **kwargs)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._lazy_get())
+
+    def __repr__(self):
+        return f"<Lazy {self.__name__}{'' if is_loaded(self) else ' (未載入)'}>"
+
+# lazy_import("numpy") 取代 import numpy；lazy_import("linebot.v3.messaging", "TextMessage") 取代 from ... import
+def lazy_import(module, attr=None):
+    if attr is None: return Lazy(lambda: importlib.import_module(module), module)
+    return Lazy(lambda: getattr(importlib.import_module(module), attr), attr, label=module, target=f"{module}.{attr}")
+
+def is_loaded(obj):
+    return not isinstance(obj, Lazy) or obj._lazy_value is not _MISSING
+
+# atexit 收尾用：沒建立過就不必為了關閉而特地建立
+def if_loaded(obj, method):
+    return lambda: is_loaded(obj) and getattr(obj, method)()
+
+# 以代理為單位：同一個模組的其他代理已經用過 (模組早就 import 了) 也只列出還沒碰過的那幾個名稱
+def pending():
+    return sorted({obj._lazy_target for obj in _registry if not is_loaded(obj)})
+
+def load_all():
+    for obj in list(_registry): obj._lazy_get()
+
+# 背景預熱：等 delay 秒 (讓伺服器先開始接 webhook) 再依註冊順序載入，載入失敗留到真正用到時再報錯
+def warmup(delay=0.0):
+    def run():
+        time.sleep(delay)
+        started = time.perf_counter()
+        for obj in list(_registry):
+            try: obj._lazy_get()
+            except Exception: logger.exception("預熱 %s 失敗", obj._lazy_target)
+        logger.info("背景預熱完成 %.0fms：%s", (time.perf_counter() - started) * 1000, report())
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread
+
+def report():
+    return " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in sorted(LOAD_TIMES.items(), key=lambda kv: -kv[1]))
+
+def snapshot_stats():
+    return {"load_ms": {name: round(seconds * 1000, 1) for name, seconds in LOAD_TIMES.items()}, "pending": pending()}
@@ -0,0 +1,55 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import count_error
+from lazy import lazy_import
+
+ApiClient, MessagingApi, MessagingApiBlob, ShowLoadingAnimationRequest = (lazy_import("linebot.v3.messaging", name) for name in (
+    "ApiClient", "MessagingApi", "MessagingApiBlob", "ShowLoadingAnimationRequest"))
+
+logger = logging.getLogger(__name__)
+
+# ==========================================
+# 整個 process 共用的 LINE API 連線
+# 原本每個事件都 `with ApiClient(configuration)`，每次都要重新建立 TCP + TLS 連線；
+# 這裡只建一個 ApiClient (底層 urllib3 PoolManager 是 thread-safe、預設 keep-alive)，
+# api.line.me 與 api-data.line.me 各自維持最多 pool_size 條連線重複使用
+# 讀取動畫改成丟到背景執行緒送出，不再卡住事件處理
+# ==========================================
+class LineClients:
+    def __init__(self, configuration, pool_size=10, background_workers=4):
+        configuration.connection_pool_maxsize = pool_size
+        self.client = ApiClient(configuration)
+        self.api = MessagingApi(self.client)
+        self.blob = MessagingApiBlob(self.client)
+        self._background = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="line-bg")
+        self.stats = {"loading_sent": 0, "loading_failed": 0}
+        self._lock = threading.Lock()   # 計數在背景執行緒上更新
+
+    def show_loading(self, chat_id, seconds):
+        self._background.submit(self._show_loading, chat_id, seconds)
+
+    def _show_loading(self, chat_id, seconds):
+        try:
+            self.api.show_loading_animation(ShowLoadingAnimationRequest(chat_id=chat_id, loading_seconds=seconds))
+            with self._lock: self.stats["loading_sent"] += 1
+        except Exception as e:
+            # 讀取動畫失敗不影響回覆 (例如群組聊天室不支援)，記錄下來就好
+            with self._lock: self.stats["loading_failed"] += 1
+            count_error("loading_animation")
+            logger.info("讀取動畫送出失敗：%s", e)
+
+    # 每個 host 建過幾條連線、送過幾個請求 (連線數遠小於請求數 = 有重複使用)
+    def pool_stats(self):
+        pools = self.client.rest_client.pool_manager.pools
+        return {key.key_host: {"connections": p.num_connections, "requests": p.num_requests}
+                for key in pools.keys() if (p := pools.get(key)) is not None}
+
+    def snapshot_stats(self):
+        with self._lock: stats = dict(self.stats)
+        return {**stats, "pools": self.pool_stats()}
+
+    def close(self):
+        self._background.shutdown(wait=True)
+        self.client.close()
@@ -0,0 +1,97 @@
+import os
+import time
+import random
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# 每個階段的耗時分佈大多落在幾 ms ~ 幾十秒 (Gemini)
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 60)
+
+STAGE_SECONDS = Histogram("linebot_stage_seconds", "各處理階段耗時", ["stage", "command"], buckets=BUCKETS)
+EVENT_SECONDS = Histogram("linebot_event_seconds", "單一事件從開始處理到回覆的總耗時", ["command", "state"], buckets=BUCKETS)
+EVENTS = Counter("linebot_events_total", "處理過的事件數", ["command", "state"])
+ERRORS = Counter("linebot_errors_total", "各階段發生的例外", ["stage"])
+SLOW_EVENTS = Counter("linebot_slow_events_total", "超過 SLOW_EVENT_SECONDS 的事件數", ["command"])
+GEMINI_TOKENS = Counter("linebot_gemini_tokens_total", "Gemini token 用量", ["label", "kind"])
+
+# ==========================================
+# 單一事件的計時 (存在 contextvar 裡，丟到別的執行緒時用 copy_context 一起帶過去)
+#   stage("gemini")：包住某一段，結束時直接記進 histogram
+#   mark("route")：計圈制，記錄「上一個 mark 到現在」扣掉中間 stage 的時間，不必為了計時把大段程式縮排
+# 只有幾次 perf_counter 與 dict 操作，正式環境可以一直開著
+# ==========================================
+class Trace:
+    __slots__ = ("command", "state", "started", "lap", "nested", "stages")
+
+    def __init__(self, command, state):
+        self.command, self.state = command, state
+        self.started = self.lap = time.perf_counter()
+        self.nested = 0.0
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        STAGE_SECONDS.labels(name, self.command).observe(seconds)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+def start_trace(command, state="NONE"):
+    trace = Trace(command, state)
+    _current.set(trace)
+    return trace
+
+def current_trace():
+    return _current.get()
+
+@contextmanager
+def stage(name, command=None):
+    started = time.perf_counter()
+    try: yield
+    except Exception:
+        ERRORS.labels(name).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        trace = _current.get()
+        if trace is None: STAGE_SECONDS.labels(name, command or "none").observe(seconds)
+        else:
+            trace.add(name, seconds)
+            trace.nested += seconds
+
+def mark(name):
+    trace = _current.get()
+    if trace is None: return
+    now = time.perf_counter()
+    trace.add(name, max(0.0, now - trace.lap - trace.nested))
+    trace.lap, trace.nested = now, 0.0
+
+def count_error(stage_name):
+    ERRORS.labels(stage_name).inc()
+
+# 事件處理完：記總耗時；超過門檻的依 sample_rate 抽樣把各階段耗時寫進 log
+def finish_trace(slow_seconds=3.0, sample_rate=1.0):
+    trace = _current.get()
+    if trace is None: return
+    _current.set(None)
+    total = time.perf_counter() - trace.started
+    EVENTS.labels(trace.command, trace.state).inc()
+    EVENT_SECONDS.labels(trace.command, trace.state).observe(total)
+    if total >= slow_seconds:
+        SLOW_EVENTS.labels(trace.command).inc()
+        if random.random() < sample_rate:
+            breakdown = " ".join(f"{k}={v * 1000:.0f}ms" for k, v in sorted(trace.stages.items(), key=lambda kv: -kv[1]))
+            logger.warning("慢事件 command=%s state=%s total=%.0fms %s", trace.command, trace.state, total * 1000, breakdown)
+
+# gunicorn 多 worker 時設定 PROMETHEUS_MULTIPROC_DIR，/metrics 會合併所有 worker 的數字
+def render():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
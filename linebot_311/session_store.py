@@ -0,0 +1,142 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+# ==========================================
+# 輕量的對話紀錄 (用 __slots__ 取代巢狀 dict，每筆只佔幾十 bytes)
+# 仍保留 record["我方"] / record["state"] 這種寫法，原本的程式不用大改
+# ==========================================
+class DuelRecord:
+    __slots__ = ("me", "opp", "target")
+    _keys = {"我方": "me", "對方": "opp", "target": "target"}
+
+    def __init__(self, me=8000, opp=8000, target=None):
+        self.me, self.opp, self.target = me, opp, target
+
+    def __getitem__(self, key): return getattr(self, self._keys[key])
+    def __setitem__(self, key, value): setattr(self, self._keys[key], value)
+    def get(self, key, default=None): return getattr(self, self._keys[key], default) if key in self._keys else default
+
+    def to_dict(self):
+        return {"我方": self.me, "對方": self.opp, "target": self.target}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get("我方", 8000), d.get("對方", 8000), d.get("target"))
+
+class StateRecord:
+    __slots__ = ("state", "data")
+
+    def __init__(self, state="NONE", data=None):
+        self.state, self.data = state, data if data is not None else {}
+
+    def __getitem__(self, key): return getattr(self, key)
+
+# 估計一筆紀錄佔多少記憶體：key + 紀錄本身 + __slots__ 裡的值 (dict 再加上裡面的 key/value)
+# 加上 OrderedDict 節點與 (到期時間, 紀錄, 大小) tuple 的固定成本；只是估計，不追蹤存進去之後的原地修改
+ENTRY_OVERHEAD = 200
+
+def estimate_size(key, record):
+    size = ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(record)
+    for value in (getattr(record, slot, None) for slot in getattr(record, "__slots__", ())):
+        size += sys.getsizeof(value)
+        if isinstance(value, dict): size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return size
+
+# ==========================================
+# 有期限的 session 存放區 (TTL + LRU)
+# - get() 與寫入會延長期限，超過 ttl 秒沒動靜就視為放棄，下次讀取時當作不存在
+# - `in` 與 store[key] 走 peek()：不延長期限、不算進命中率，一個事件裡查好幾次也只有開頭那次 get() 算數
+# - 兩個上限，超過任何一個就從最久沒用的開始丟掉：
+#   max_entries 是筆數；max_bytes 是用 estimate_size 估出來的記憶體用量 (None = 不限)
+# - on_expire(key, record)：過期時呼叫 (例如順便刪掉存檔)；LRU 擠掉的不會呼叫
+# ==========================================
+class SessionStore:
+    def __init__(self, ttl, max_entries=10000, on_expire=None, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_expire = on_expire
+        self._data = OrderedDict()  # key -> (expires_at, record, 估計大小)，越前面越久沒用
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def get(self, key, default=None):
+        expired = None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return default
+            if item[0] <= time.monotonic():
+                self._discard(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                expired = item[1]
+            else:
+                self._data[key] = (time.monotonic() + self.ttl, item[1], item[2])
+                self._data.move_to_end(key)
+                self.stats["hits"] += 1
+                return item[1]
+        if self.on_expire: self.on_expire(key, expired)
+        return default
+
+    def peek(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+        return item[1] if item is not None and item[0] > time.monotonic() else default
+
+    def __getitem__(self, key):
+        record = self.peek(key)
+        if record is None: raise KeyError(key)
+        return record
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def __setitem__(self, key, record):
+        size = estimate_size(key, record)
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (time.monotonic() + self.ttl, record, size)
+            self._bytes += size
+            expired = self._sweep()
+            while self._data and (len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes)):
+                self._discard(next(iter(self._data)))
+                self.stats["evicted"] += 1
+        if self.on_expire:
+            for k, r in expired: self.on_expire(k, r)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._discard(key)
+        return item[1] if item else default
+
+    def __delitem__(self, key):
+        if self.pop(key) is None: raise KeyError(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _discard(self, key):
+        item = self._data.pop(key, None)
+        if item: self._bytes -= item[2]
+        return item
+
+    # 最舊的永遠在最前面，所以只要從頭清到第一筆沒過期的就好
+    def _sweep(self):
+        now, expired = time.monotonic(), []
+        while self._data:
+            key, (expires_at, record, _) = next(iter(self._data.items()))
+            if expires_at > now: break
+            self._discard(key)
+            self.stats["expired"] += 1
+            expired.append((key, record))
+        return expired
+
+    def snapshot_stats(self):
+        with self._lock:
+            return {**self.stats, "size": len(self._data), "capacity": self.max_entries,
+                    "bytes": self._bytes, "max_bytes": self.max_bytes}